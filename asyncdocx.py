@@ -0,0 +1,211 @@
+'''
+asyncio front end to the docx module, for Python 3.7 and later.
+
+Loading, replacing, serializing and compressing a document are done in an
+executor, so the event loop keeps serving other requests meanwhile. lxml and
+zlib release the GIL for most of that work, so a thread pool is used by
+default.
+
+    doc = await AsyncDocx.open('template.docx')
+    await doc.paragraph('Hello')
+    await doc.advReplace('__name__', 'Ann')
+    data = await doc.save_async()
+
+    renderer = AsyncRenderer('template.docx', populate, concurrency=4)
+    async for result in renderer.render(records):
+        ...
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+'''
+
+import asyncio
+import collections
+import functools
+import threading
+
+from docx import Docx, _Template, _iszipdata, _render, _templatesource
+
+
+def _run(executor, func, *args, **kwargs):
+    '''Return a future running func(*args, **kwargs) in executor'''
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(executor,
+                                functools.partial(func, *args, **kwargs))
+
+
+class AsyncDocx(object):
+    ''' A Docx whose slow methods are awaited instead of blocking
+
+    Methods run one at a time, in the order they are awaited, as a Docx
+    isn't thread safe. The methods of the Docx are available here as
+    coroutines, doc.paragraph(...) runs docx.paragraph(...) through call().
+    Other attributes of the Docx are read as they are.
+    '''
+
+    def __init__(self, docx, executor=None):
+        '''
+        @param Docx docx:          The document
+        @param Executor executor:  Where to run methods, None for the
+                                   loop's default thread pool
+        '''
+        self.docx = docx
+        self.executor = executor
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, template=None, executor=None, **kwargs):
+        '''Load a template, see Docx(), and return it as an AsyncDocx'''
+        docx = await _run(executor, Docx, template, **kwargs)
+        return cls(docx, executor)
+
+    async def call(self, name, *args, **kwargs):
+        '''Await the result of the Docx method name called with args
+
+        Cancelling the call before it has started drops it. Once started,
+        the method runs to completion in the executor, and the next call
+        still waits for it.
+        '''
+        method = getattr(self.docx, name)
+        cancelled = threading.Event()
+
+        def run():
+            if not cancelled.is_set():
+                return method(*args, **kwargs)
+
+        async with self._lock:
+            future = _run(self.executor, run)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                cancelled.set()
+                # Hold the lock until the executor is done with the Docx
+                while not future.done():
+                    try:
+                        await asyncio.wait([future])
+                    except asyncio.CancelledError:
+                        pass
+                raise
+
+    async def save_async(self, output=None, **kwargs):
+        '''Save the document, see Docx.savedocx()
+
+        @return bytes  The document when output is None, or None
+        '''
+        if output is None:
+            return await self.call('tobytes', **kwargs)
+        await self.call('savedocx', output, **kwargs)
+
+    async def close(self):
+        '''Close the template, see Docx.close()'''
+        await self.call('close')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *excinfo):
+        await self.close()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.docx, name)
+        if callable(attribute):
+            return functools.partial(self.call, name)
+        return attribute
+
+
+class AsyncRenderer(object):
+    ''' Render many documents from one template without blocking
+
+    For each record a Docx is created from the template, populate(docx,
+    record) is called and the document is saved, all in the executor. The
+    template is parsed once, a path through the template cache and data
+    when the first record is rendered.
+    '''
+
+    def __init__(self, template, populate, output=None, concurrency=4,
+                 executor=None):
+        '''
+        @param mixed    template:    Path, data or file object of the
+                                     template, None for the default
+        @param callable populate:    Called with (docx, record)
+        @param mixed    output:      None to get the bytes of each document,
+                                     or a format string or callable giving
+                                     the path to save to, see
+                                     MailMerge.iterrender()
+        @param int      concurrency: Most documents being rendered at once
+        @param Executor executor:    Where to render, None for the loop's
+                                     default thread pool
+        '''
+        if template is not None:
+            template = _templatesource(template)
+        self.template = template
+        self.populate = populate
+        self.output = output
+        self.concurrency = concurrency
+        self.executor = executor
+        # The template parsed by _loadtemplate() when it is data
+        self._parsed = None
+
+    async def render(self, records, ordered=True):
+        '''Yield a RenderResult for each of records as it is rendered
+
+        records may be an iterable or an async iterable. No more than
+        concurrency records are taken from it before their results have
+        been consumed, so a slow consumer slows down rendering instead of
+        results piling up. Errors are reported in the results. Closing or
+        cancelling the iteration cancels the renders not started yet.
+
+        @param bool ordered: Yield the results in the order of records,
+                             rather than as they are done
+        '''
+        pending = collections.deque()
+        try:
+            template = await self._loadtemplate()
+            index = 0
+            async for record in _aiter(records):
+                pending.append(_run(self.executor, _render, template,
+                                    self.populate, self.output, index,
+                                    record))
+                index += 1
+                if len(pending) >= self.concurrency:
+                    yield await _next(pending, ordered)
+            while pending:
+                yield await _next(pending, ordered)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _loadtemplate(self):
+        '''Return the template to pass to Docx, parsing data templates,
+        which the template cache doesn't keep, once'''
+        if not _iszipdata(self.template):
+            return self.template
+        if self._parsed is None:
+            # Two renders racing here only cost a duplicate parse
+            self._parsed = await _run(self.executor, _Template, self.template)
+        return self._parsed
+
+    async def renderall(self, records, ordered=True):
+        '''Return the list of RenderResults of records, see render()'''
+        return [result async for result in self.render(records, ordered)]
+
+
+async def _aiter(records):
+    '''Iterate over an iterable or an async iterable'''
+    if hasattr(records, '__aiter__'):
+        async for record in records:
+            yield record
+    else:
+        for record in records:
+            yield record
+
+
+async def _next(pending, ordered):
+    '''Remove and return the result of the next of pending to finish'''
+    if ordered:
+        return await pending.popleft()
+    done = (await asyncio.wait(pending,
+                               return_when=asyncio.FIRST_COMPLETED))[0]
+    future = done.pop()
+    pending.remove(future)
+    return future.result()
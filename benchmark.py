@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+This file times building, editing, reading and saving a synthetic document
+and writes the results as JSON, so they can be compared between revisions.
+
+The document has N paragraphs, an R x C table, M images and K paragraphs
+holding placeholders. Each phase reports its time, its throughput, the
+peak resident size of the process after it and how much that grew during
+it, and, on Python 3, the peak memory Python allocated during it. Python's
+count leaves out what libxml2 allocates, which is most of a document, so
+the resident size is the one to watch. The document is saved with
+several compression policies, whose phases also report the size of the
+file written, to show what speed costs in size.
+
+    benchmark.py -n 5000 -r 200 -c 6 -m 20 -k 500 -o results.json
+
+Part of Python's docx module - http://github.com/mikemaccana/python-docx
+See LICENSE for licensing information.
+"""
+
+import io
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from docx import CompressionPolicy, Docx
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Save phases showing the size / speed trade-off of compression policies
+COMPRESSIONS = [
+    ('save', None),
+    ('save-stored', CompressionPolicy(0)),
+    ('save-fastest', CompressionPolicy(1)),
+    ('save-smallest', CompressionPolicy(9)),
+    ('save-threads', CompressionPolicy(threads=4))]
+
+
+def maxrss():
+    '''Return the peak resident size of the process in bytes, or None'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes everywhere but on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def makeimages(count, size=64):
+    '''Return count distinct PNG images, so none of them are shared'''
+    images = []
+    for i in range(count):
+        image = Image.new('RGB', (size, size),
+                          (i % 256, (i // 256) % 256, 127))
+        data = io.BytesIO()
+        image.save(data, 'PNG')
+        images.append(data.getvalue())
+    return images
+
+
+def timephase(results, name, items, unit, func, *args):
+    '''Run func(*args) and add its timings to results, return its result'''
+    rssbefore = maxrss()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = timer()
+    result = func(*args)
+    seconds = timer() - start
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    rss = maxrss()
+    results.append({
+        'phase': name,
+        'seconds': seconds,
+        'items': items,
+        'unit': unit,
+        'throughput': items / seconds if seconds else None,
+        'peakmemory': peak,
+        'maxrss': rss,
+        'rssgrowth': rss - rssbefore if rss is not None else None})
+    return result
+
+
+def build(docx, options, images):
+    '''Add the paragraphs, placeholders, table and images'''
+    for i in range(options.paragraphs):
+        docx.paragraph('Paragraph %d of the benchmark document, with enough '
+                       'text in it to look like a real one.' % i)
+    for i in range(options.placeholders):
+        # One placeholder in a single run and one Word style split over runs
+        docx.paragraph([('Dear __a%d__, ' % i, ''), ('__b', ''),
+                        ('%d__' % i, ''), ('.', '')])
+    docx.table([['Heading %d' % c for c in range(options.columns)]] +
+               [['Cell %d,%d' % (r, c) for c in range(options.columns)]
+                for r in range(options.rows)])
+    for i, image in enumerate(images):
+        docx.picture(image, 'Image %d' % i, picname='image%d.png' % i)
+
+
+def replace(docx, options):
+    '''Fill in both kinds of placeholders'''
+    docx.replacemany(dict(('__a%d__' % i, 'Name %d' % i)
+                          for i in range(options.placeholders)))
+    docx.advReplace(r'__b\d+__', 'Split')
+
+
+def extract(docx):
+    return docx.getdocumenttext(), docx.gettables()
+
+
+def revision():
+    '''Return the git revision of the module, or None'''
+    try:
+        process = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        output = process.communicate()[0]
+    except OSError:
+        return None
+    if process.returncode:
+        return None
+    return output.decode('ascii').strip()
+
+
+def run(options):
+    '''Run every phase, return the results as a dict'''
+    results = []
+    images = makeimages(options.images)
+    elements = (options.paragraphs + options.placeholders +
+                options.rows + 1 + options.images)
+    outputfile, output = tempfile.mkstemp(suffix='.docx')
+    os.close(outputfile)
+    try:
+        docx = timephase(results, 'construct', 1, 'documents', Docx)
+        timephase(results, 'build', elements, 'elements', build,
+                  docx, options, images)
+        timephase(results, 'replace', options.placeholders * 2,
+                  'placeholders', replace, docx, options)
+        timephase(results, 'extract', elements, 'elements', extract, docx)
+        documentsize = len(etree.tostring(docx._document))
+        for name, compression in COMPRESSIONS:
+            timephase(results, name, documentsize, 'xml bytes',
+                      docx.savedocx, output, False, False, compression)
+            results[-1]['outputbytes'] = os.path.getsize(output)
+        outputsize = results[-len(COMPRESSIONS)]['outputbytes']
+    finally:
+        os.remove(output)
+
+    return {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'lxml': etree.__version__,
+        'tracemalloc': tracemalloc is not None,
+        'memory': ('peakmemory counts Python allocations only, not '
+                   'libxml2 ones; maxrss and rssgrowth count both'),
+        'parameters': {
+            'paragraphs': options.paragraphs,
+            'rows': options.rows,
+            'columns': options.columns,
+            'images': options.images,
+            'placeholders': options.placeholders},
+        'phases': results,
+        'documentbytes': documentsize,
+        'outputbytes': outputsize}
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--paragraphs', type='int', default=2000,
+                      help='number of plain paragraphs [%default]')
+    parser.add_option('-r', '--rows', type='int', default=100,
+                      help='number of table rows [%default]')
+    parser.add_option('-c', '--columns', type='int', default=5,
+                      help='number of table columns [%default]')
+    parser.add_option('-m', '--images', type='int', default=10,
+                      help='number of images [%default]')
+    parser.add_option('-k', '--placeholders', type='int', default=200,
+                      help='number of paragraphs with placeholders '
+                           '[%default]')
+    parser.add_option('-o', '--output',
+                      help='write the results to this file instead of '
+                           'standard output')
+    options, args = parser.parse_args(argv)
+
+    text = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        outputfile = open(options.output, 'w')
+        try:
+            outputfile.write(text + '\n')
+        finally:
+            outputfile.close()
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,1145 @@ import zipfile
 import re
 import time
 import os
+import bisect
+import collections
+import copy
+import functools
+import hashlib
+import io
+import itertools
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import traceback
+import zlib
+    
+try:
+    unicode
+except NameError:
+    # Python 3
+    unicode = str
+    basestring = str
+    
+try:
+    from itertools import izip as _izip
+except ImportError:
+    # Python 3
+    _izip = zip
     
 log = logging.getLogger(__name__)
 
+
+def _seekrawmember(fp, zipInfo):
+    '''Move fp to the start of the data of a zip member'''
+    fp.seek(zipInfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           fp.read(zipfile.sizeFileHeader))
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH]
+            + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+
+def _readrawmember(fp, zipInfo):
+    '''Return the data of a zip member as it is stored, still compressed'''
+    _seekrawmember(fp, zipInfo)
+    return fp.read(zipInfo.compress_size)
+
+
+def _writerawmember(docxfile, zipInfo, data=None, source=None):
+    '''Add the still compressed data of a member of another zip to docxfile
+    
+    The data is either given, as read by _readrawmember(), or copied over in
+    chunks from source, a file positioned by _seekrawmember().
+
+    zipfile has no public API for this, so this does what ZipFile.writestr()
+    does after compressing.
+    '''
+    zinfo = zipfile.ZipInfo(zipInfo.filename, zipInfo.date_time)
+    zinfo.compress_type = zipInfo.compress_type
+    zinfo.external_attr = zipInfo.external_attr
+    zinfo.CRC = zipInfo.CRC
+    zinfo.file_size = zipInfo.file_size
+    zinfo.compress_size = zipInfo.compress_size if data is None else len(data)
+    zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT
+             or zinfo.compress_size > zipfile.ZIP64_LIMIT)
+
+    lock = getattr(docxfile, '_lock', None)
+    if lock is not None:
+        lock.acquire()
+    try:
+        if getattr(docxfile, '_writing', False):
+            raise ValueError("Can't write to the ZIP file while there is "
+                             "an open writing handle")
+        if hasattr(docxfile, 'start_dir') and getattr(docxfile, '_seekable',
+                                                      True):
+            docxfile.fp.seek(docxfile.start_dir)
+        zinfo.header_offset = docxfile.fp.tell()
+        docxfile._writecheck(zinfo)
+        docxfile._didModify = True
+        docxfile.fp.write(zinfo.FileHeader(zip64))
+        if data is not None:
+            docxfile.fp.write(data)
+        else:
+            remaining = zinfo.compress_size
+            while remaining:
+                chunk = source.read(min(remaining, 1 << 16))
+                if not chunk:
+                    raise zipfile.BadZipfile('%s is truncated'
+                                             % zinfo.filename)
+                docxfile.fp.write(chunk)
+                remaining -= len(chunk)
+        docxfile.filelist.append(zinfo)
+        docxfile.NameToInfo[zinfo.filename] = zinfo
+        if hasattr(docxfile, 'start_dir'):
+            docxfile.start_dir = docxfile.fp.tell()
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def _displaysize(origwidth, origheight, pixelwidth, pixelheight,
+                 nochangeaspect, noscaleup):
+    '''Return the size to show an image at, see Docx.picture()'''
+    if not pixelwidth and not pixelheight:
+        # If not, get info from the picture itself
+        pixelwidth = origwidth
+        pixelheight = origheight
+        
+    elif not pixelwidth:
+        pixelwidth = origwidth
+
+        if origheight < pixelheight and noscaleup:
+          pixelheight = origheight
+          
+        elif nochangeaspect:
+            pixelwidth = pixelwidth * pixelheight // origheight
+        
+    elif not pixelheight:
+        pixelheight = origheight
+        
+        if origwidth < pixelwidth and noscaleup:
+          pixelwidth = origwidth
+          
+        elif nochangeaspect:
+            pixelheight = pixelheight * pixelwidth // origwidth
+    
+    return pixelwidth, pixelheight
+
+
+def _readimage(image):
+    '''Return the data and file name of an image given as a path, a file
+    object or its data'''
+    image = _fspath(image)
+    if hasattr(image, 'read'):
+        return image.read(), getattr(image, 'name', None)
+    
+    if isinstance(image, memoryview):
+        return image.tobytes(), None
+    if isinstance(image, bytearray):
+        return bytes(image), None
+    
+    # Python 2 paths are bytes too, but never hold a NUL
+    if isinstance(image, bytes) and (bytes is not str or b'\0' in image):
+        return image, None
+    
+    if not os.path.isfile(image):
+        raise Exception('|%s| is not a valid file' % image)
+    
+    with open(image, 'rb') as f:
+        return f.read(), image
+
+
+# JPEG start of frame markers, the frame header holds the image size
+_JPEGSOF = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                      0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+
+
+def _imageinfo(data):
+    '''Return the file extension, width and height of an image
+    
+    The size is read from the header of PNG, GIF, JPEG and BMP images, other
+    formats are left to PIL, which also only reads the header.
+    '''
+    try:
+        if data[:8] == b'\x89PNG\r\n\x1a\n':
+            return ('.png',) + struct.unpack_from('>II', data, 16)
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            return ('.gif',) + struct.unpack_from('<HH', data, 6)
+        if data[:2] == b'BM':
+            width, height = struct.unpack_from('<ii', data, 18)
+            return '.bmp', width, abs(height)
+        if data[:2] == b'\xff\xd8':
+            offset = 2
+            while offset + 9 <= len(data):
+                mark, marker, length = struct.unpack_from('>BBH', data, offset)
+                if mark != 0xFF:
+                    break
+                if marker == 0xFF:
+                    # Fill byte
+                    offset += 1
+                    continue
+                if marker in _JPEGSOF:
+                    height, width = struct.unpack_from('>HH', data, offset + 5)
+                    return '.jpeg', width, height
+                offset += 2 + length
+    except struct.error:
+        pass
+    
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size[0:2]
+    return '.' + (image.format or 'img').lower(), width, height
+
+
+def _fspath(path):
+    '''Return a path object, such as a pathlib.Path, as a string and
+    anything else as it is'''
+    fspath = getattr(path, '__fspath__', None)
+    if fspath is not None:
+        return fspath()
+    return path
+
+
+# Replaces an existing file too, on Python 2 only outside of Windows
+_replacefile = getattr(os, 'replace', os.rename)
+
+
+def _iszipdata(source):
+    '''Return whether source is the data of a zip file rather than a path'''
+    return isinstance(source, bytes) and source[:4] == b'PK\x03\x04'
+
+
+def _templatesource(template):
+    '''Return a template given as a path, its data or a file object as
+    either its path or its data'''
+    template = _fspath(template)
+    if hasattr(template, 'read'):
+        template = template.read()
+    elif isinstance(template, memoryview):
+        template = template.tobytes()
+    elif isinstance(template, bytearray):
+        template = bytes(template)
+    if _iszipdata(template):
+        return template
+    if isinstance(template, bytes) and bytes is not str:
+        # A path given as bytes on Python 3
+        template = template.decode(sys.getfilesystemencoding())
+    if not isinstance(template, basestring):
+        raise Exception('template docx is neither a path nor a docx file')
+    return template
+
+
+class _UnseekableOutput(object):
+    ''' Output that can't seek back, such as a socket or a pipe
+
+    zipfile only asks for the position and seeks to where it already is
+    when every member is written with its size and CRC known up front, as
+    _writerawmember() does, so counting the bytes written is enough.
+    '''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._position = 0
+
+    def write(self, data):
+        self._stream.write(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        if whence == 2 or offset != self._position:
+            raise IOError('output is not seekable')
+        return self._position
+
+    def flush(self):
+        if hasattr(self._stream, 'flush'):
+            self._stream.flush()
+
+
+def _outputstream(output):
+    '''Return output, a path or a file object, as zipfile can write it'''
+    output = _fspath(output)
+    if isinstance(output, basestring):
+        return output
+    if not hasattr(output, 'write'):
+        raise Exception('output is neither a path nor a writable file')
+    seekable = getattr(output, 'seekable', None)
+    if seekable is not None:
+        if seekable():
+            return output
+    else:
+        try:
+            output.seek(output.tell())
+            return output
+        except (AttributeError, IOError, OSError):
+            pass
+    return _UnseekableOutput(output)
+
+
+class _PackageReader(object):
+    ''' Read access to the members of a docx package
+
+    The package is a path, its data or a seekable file object. It is opened
+    and its central directory parsed once, then kept open until close(). A
+    closed package is opened again when it is read from. With usemmap, a
+    package on disk is mapped into memory instead of being read through a
+    file. Members may be read from any thread.
+
+    A package on disk that is replaced while open is still read from the
+    file that was opened. Once closed it can only be opened again if the
+    file on disk is still the one that was loaded.
+    '''
+
+    def __init__(self, source, usemmap=False):
+        if hasattr(source, 'read'):
+            self.path = None
+            self._data = None
+            self._source = source
+        else:
+            source = _templatesource(source)
+            self._source = None
+            if _iszipdata(source):
+                self.path = None
+                self._data = source
+            else:
+                self.path = source
+                self._data = None
+        self.usemmap = usemmap
+        self._fp = None
+        self._buffer = None
+        self._zipfile = None
+        self._lock = threading.RLock()
+        # mtime and size of the file first opened
+        self._stamp = None
+        self.infolist = self._open().infolist()
+
+    def _openfile(self):
+        '''Open the package file, checking that it is the one loaded'''
+        fp = open(self.path, 'rb')
+        stat = os.fstat(fp.fileno())
+        stamp = (stat.st_mtime, stat.st_size)
+        if self._stamp is not None and stamp != self._stamp:
+            fp.close()
+            raise Exception("template docx |%s| changed since it was loaded"
+                            % self.path)
+        self._stamp = stamp
+        return fp
+
+    def _open(self):
+        '''Return the ZipFile of the package, opening it if needed'''
+        if self._zipfile is None:
+            if self._source is not None:
+                self._fp = self._source
+            elif self._data is not None:
+                self._fp = io.BytesIO(self._data)
+                self._buffer = self._data
+            else:
+                self._fp = self._openfile()
+                if self.usemmap:
+                    self._buffer = mmap.mmap(self._fp.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+            self._zipfile = zipfile.ZipFile(self._fp)
+        return self._zipfile
+
+    def read(self, name):
+        '''Return the uncompressed data of a member'''
+        with self._lock:
+            return self._open().read(name)
+
+    def readraw(self, zipInfo):
+        '''Return the data of a member as it is stored, still compressed'''
+        with self._lock:
+            self._open()
+            if self._buffer is None:
+                return _readrawmember(self._fp, zipInfo)
+            offset = zipInfo.header_offset
+            header = struct.unpack(
+                zipfile.structFileHeader,
+                self._buffer[offset:offset + zipfile.sizeFileHeader])
+            start = (offset + zipfile.sizeFileHeader
+                     + header[zipfile._FH_FILENAME_LENGTH]
+                     + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+            return self._buffer[start:start + zipInfo.compress_size]
+
+    def copyraw(self, docxfile, zipInfo):
+        '''Copy a member into docxfile without recompressing it'''
+        with self._lock:
+            self._open()
+            if self._buffer is not None:
+                _writerawmember(docxfile, zipInfo, self.readraw(zipInfo))
+            else:
+                _seekrawmember(self._fp, zipInfo)
+                _writerawmember(docxfile, zipInfo, source=self._fp)
+
+    def open(self, name):
+        '''Return a file object decompressing a member as it is read
+        
+        Nothing else may read from the package until it is closed.
+        '''
+        with self._lock:
+            return self._open().open(name)
+
+    def close(self):
+        '''Close the package file, file objects given are left open'''
+        with self._lock:
+            if self._zipfile is None:
+                return
+            self._zipfile.close()
+            if isinstance(self._buffer, mmap.mmap):
+                self._buffer.close()
+            if self._fp is not self._source:
+                self._fp.close()
+            self._zipfile = self._fp = self._buffer = None
+
+
+class _Template(object):
+    ''' Parsed contents of a template docx
+
+    Instances are shared between every Docx built from the same template, so
+    nothing in here may be modified after loading. Docx takes its own copy of
+    the mutable parts (the document tree and the relationship list).
+
+    Every member but word/document.xml is kept as it is stored in the
+    template, still compressed, so savedocx can copy unchanged parts without
+    recompressing them. Media isn't read at all up front, it is read from the
+    template package, which stays open, when it is used.
+    '''
+
+    documentPath = 'word/document.xml'
+    relsPath = 'word/_rels/document.xml.rels'
+    mediaPrefix = 'word/media/'
+    # Compressions we can copy without going through zipfile
+    rawtypes = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+    def __init__(self, path, usemmap=False):
+        '''
+        @param mixed path:    Path of the template, or its data as read by
+                              _templatesource()
+        @param bool usemmap:  Map the template into memory
+        '''
+        self.package = _PackageReader(path, usemmap)
+        self.path = self.package.path
+        self.document = None
+        self.relationships = _Relationships()
+        # Names of the template media, relative to mediaPrefix
+        self.medianames = []
+        # Zip member name: (ZipInfo, stored data). The data of media is None
+        # until it is needed.
+        self.parts = {}
+
+        for zipInfo in self.package.infolist:
+            name = zipInfo.filename
+            if name == self.documentPath:
+                self.document = etree.fromstring(self.package.read(name))
+            elif (zipInfo.compress_type not in self.rawtypes
+                  or zipInfo.flag_bits & 0x1):
+                # Encrypted or unusual compression, store uncompressed
+                self.parts[name] = (None, self.package.read(name))
+            elif name.startswith(self.mediaPrefix):
+                self.parts[name] = (zipInfo, None)
+            else:
+                self.parts[name] = (zipInfo, self.package.readraw(zipInfo))
+            if name.startswith(self.mediaPrefix):
+                self.medianames.append(name[len(self.mediaPrefix):])
+
+        if self.document is None:
+            self.package.close()
+            raise Exception("template docx |%s| has no %s"
+                            % (self.path or '<data>', self.documentPath))
+
+        if self.relsPath in self.parts:
+            rels = etree.fromstring(self.read(self.relsPath))
+            for node in rels.getchildren():
+                self.relationships.add(node.get('Type'), node.get('Target'),
+                                       node.get('TargetMode'), node.get('Id'))
+
+    def read(self, name):
+        '''Return the uncompressed data of a member'''
+        zipInfo, data = self.parts[name]
+        if data is None:
+            data = self.package.readraw(zipInfo)
+        if zipInfo is None or zipInfo.compress_type == zipfile.ZIP_STORED:
+            return data
+        return zlib.decompress(data, -15)
+
+    def readmedia(self, name):
+        '''Return the data of a template media file'''
+        return self.read(self.mediaPrefix + name)
+
+    def write(self, docxfile, name, policy=None):
+        '''Copy a member into docxfile without recompressing it
+        
+        @param CompressionPolicy policy: Compresses the members we can't
+                                         copy as they are
+        '''
+        zipInfo, data = self.parts[name]
+        if zipInfo is None:
+            if policy is None:
+                policy = CompressionPolicy()
+            _writerawmember(docxfile, *policy.compress(name, data))
+        elif data is not None:
+            _writerawmember(docxfile, zipInfo, data)
+        else:
+            self.package.copyraw(docxfile, zipInfo)
+
+    def close(self):
+        '''Close the template package, it is opened again if needed'''
+        self.package.close()
+
+
+class _Relationships(object):
+    ''' The relationships of a part, by id
+
+    New relationships are numbered after the highest numbered id so far, and
+    adding a (type, target) pair that is already there returns its id.
+    '''
+
+    def __init__(self):
+        # id -> (type, target, target mode)
+        self._byid = {}
+        # (type, target) -> id
+        self._bytarget = {}
+        # Ids in the order they were added
+        self._ids = []
+        self._next = 1
+
+    def add(self, reltype, target, targetmode=None, id_=None):
+        '''Return the id of the relationship to target, adding it if needed
+        
+        @param str id_: Id to use instead of the next free one
+        '''
+        key = (reltype, target)
+        if id_ is None:
+            id_ = self._bytarget.get(key)
+            if id_ is not None:
+                return id_
+            id_ = 'rId%d' % self._next
+            while id_ in self._byid:
+                self._next += 1
+                id_ = 'rId%d' % self._next
+        elif id_ in self._byid:
+            raise Exception('relationship id |%s| is already in use' % id_)
+        
+        self._byid[id_] = (reltype, target, targetmode)
+        self._bytarget.setdefault(key, id_)
+        self._ids.append(id_)
+        if id_.startswith('rId') and id_[3:].isdigit():
+            self._next = max(self._next, int(id_[3:]) + 1)
+        return id_
+
+    def get(self, id_):
+        '''Return the (type, target, target mode) of a relationship'''
+        return self._byid[id_]
+
+    def find(self, reltype, target):
+        '''Return the id of the relationship to target, or None'''
+        return self._bytarget.get((reltype, target))
+
+    def copy(self):
+        relationships = _Relationships()
+        relationships._byid = dict(self._byid)
+        relationships._bytarget = dict(self._bytarget)
+        relationships._ids = list(self._ids)
+        relationships._next = self._next
+        return relationships
+
+    def __contains__(self, id_):
+        return id_ in self._byid
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def items(self):
+        return [(id_, self._byid[id_]) for id_ in self._ids]
+
+
+class _MediaStore(object):
+    ''' The media of a document, by name
+
+    Template media is only read from the template when it is asked for, and
+    is copied straight from the template on save unless it is replaced.
+    '''
+
+    def __init__(self, template):
+        self._template = template
+        self._fromtemplate = set(template.medianames)
+        self._data = {}
+
+    def istemplate(self, name):
+        '''Return whether name is still the template's own media'''
+        return name in self._fromtemplate
+
+    def __contains__(self, name):
+        return name in self._data or name in self._fromtemplate
+
+    def __getitem__(self, name):
+        if name in self._data:
+            return self._data[name]
+        if name in self._fromtemplate:
+            return self._template.readmedia(name)
+        raise KeyError(name)
+
+    def __setitem__(self, name, data):
+        self._fromtemplate.discard(name)
+        self._data[name] = data
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._fromtemplate.discard(name)
+        self._data.pop(name, None)
+
+    def __iter__(self):
+        for name in self._template.medianames:
+            if name in self._fromtemplate:
+                yield name
+        for name in self._data:
+            yield name
+
+    def __len__(self):
+        return len(self._fromtemplate) + len(self._data)
+
+    def load(self):
+        '''Read all the template media into memory'''
+        for name in list(self._fromtemplate):
+            self[name] = self._template.readmedia(name)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+class TemplateCache(object):
+    ''' Process wide LRU cache of parsed templates
+
+    Templates are keyed by their absolute path along with their mtime and size,
+    so a template that is changed on disk is reloaded the next time it is
+    used. Use invalidate() to drop entries explicitly.
+    '''
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Least recently used key first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return (path, stat.st_mtime, stat.st_size)
+
+    def get(self, path, usemmap=False):
+        '''Return the parsed template for path, loading it on a miss
+        
+        @param bool usemmap: Map the template into memory when it is loaded
+        '''
+        key = self._key(path)
+        with self._lock:
+            template = self._entries.pop(key, None)
+            if template is not None:
+                self.hits += 1
+                self._entries[key] = template
+                return template
+            self.misses += 1
+
+        # Parse outside of the lock, two threads racing for the same template
+        # only costs a duplicate parse.
+        template = _Template(path, usemmap)
+
+        dropped = []
+        with self._lock:
+            if key not in self._entries:
+                # Drop stale versions of this path along with the key
+                for oldkey in [k for k in self._entries if k[0] == key[0]]:
+                    dropped.append(self._entries.pop(oldkey))
+            else:
+                dropped.append(self._entries.pop(key))
+            self._entries[key] = template
+            while len(self._entries) > self.maxsize:
+                dropped.append(self._entries.popitem(last=False)[1])
+        self._close(dropped)
+        return template
+
+    def invalidate(self, path=None):
+        '''Drop path from the cache, or every template if path is None'''
+        with self._lock:
+            if path is None:
+                dropped = list(self._entries.values())
+                self._entries.clear()
+            else:
+                path = os.path.abspath(path)
+                dropped = [self._entries.pop(key) for key in list(self._entries)
+                           if key[0] == path]
+        self._close(dropped)
+
+    def _close(self, templates):
+        # Documents still using one of these open it again when they read
+        # from it
+        for template in templates:
+            template.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+templatecache = TemplateCache()
+
+
+class PrototypeCache(object):
+    ''' Prebuilt element subtrees that are copied instead of being built
+    node by node
+
+    Builders ask for a subtree by a key describing it, such as the style and
+    justification of a paragraph, and get a copy of the prototype. hits and
+    misses count how often a prototype could be reused.
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._prototypes = {}
+
+    def get(self, key, build, *args):
+        '''Return a copy of the prototype for key, calling build(*args) to
+        make it the first time'''
+        prototype = self._prototypes.get(key)
+        if prototype is None:
+            self.misses += 1
+            prototype = build(*args)
+            if len(self._prototypes) >= self.maxsize:
+                return prototype
+            self._prototypes[key] = prototype
+        else:
+            self.hits += 1
+        return copy.deepcopy(prototype)
+
+    def clear(self):
+        '''Drop all prototypes and reset the counters'''
+        self._prototypes.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._prototypes)
+
+
+prototypecache = PrototypeCache()
+
+
+# Best downsampling filter of the PIL version at hand
+_RESAMPLE = getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', None))
+
+
+class ImageOptimizer(object):
+    ''' Resamples and re-encodes images for the size they are shown at
+
+    Images are scaled down to their display size times scale, so they stay
+    sharp on screens and printers of scale times the display resolution.
+    JPEG images are re-encoded with quality, everything else becomes an
+    optimized PNG. Images that would not get smaller are kept as they are.
+    Results are cached by the hash of the source data, the display size and
+    the settings.
+    '''
+
+    def __init__(self, scale=2.0, quality=85, stripmetadata=True, maxsize=64,
+                 threads=None):
+        '''
+        @param float scale:        Pixels per display pixel to keep
+        @param int quality:        JPEG quality, 1 to 95
+        @param bool stripmetadata: Drop EXIF data and colour profiles
+        @param int maxsize:        Number of optimized images to cache
+        @param int threads:        Threads used by optimizemany(), defaults
+                                   to the number of cpus
+        '''
+        self.scale = scale
+        self.quality = quality
+        self.stripmetadata = stripmetadata
+        self.maxsize = maxsize
+        self.threads = threads
+        self.hits = 0
+        self.misses = 0
+        # Least recently used key first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def optimize(self, data, width, height):
+        '''Return the optimized data and file extension of an image shown
+        at width x height pixels'''
+        key = self._key(data, width, height)
+        with self._lock:
+            result = self._entries.pop(key, None)
+            if result is not None:
+                self.hits += 1
+                self._entries[key] = result
+                return result
+            self.misses += 1
+
+        # PIL releases the GIL while resampling and encoding, so threads
+        # optimizing different images run in parallel.
+        result = self._optimize(data, width, height)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = result
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def optimizemany(self, images):
+        '''Optimize (data, width, height) tuples in a thread pool, return
+        a list of (data, extension)'''
+        images = list(images)
+        keys = [self._key(*image) for image in images]
+        # Repeated images are only optimized once
+        unique = dict(zip(keys, images))
+        pool = multiprocessing.pool.ThreadPool(self.threads)
+        try:
+            results = dict(zip(unique, pool.map(
+                lambda image: self.optimize(*image), unique.values())))
+        finally:
+            pool.close()
+            pool.join()
+        return [results[key] for key in keys]
+
+    def _key(self, data, width, height):
+        return (hashlib.sha1(data).hexdigest(), width, height,
+                self.scale, self.quality, self.stripmetadata)
+
+    def _optimize(self, data, width, height):
+        image = Image.open(io.BytesIO(data))
+        source = image.format
+        target = (max(1, int(round(width * self.scale))),
+                  max(1, int(round(height * self.scale))))
+        resized = target[0] < image.size[0] and target[1] < image.size[1]
+        if resized:
+            image = image.resize(target, _RESAMPLE)
+
+        options = {'optimize': True}
+        if not self.stripmetadata:
+            for name in ('exif', 'icc_profile'):
+                if image.info.get(name):
+                    options[name] = image.info[name]
+        if source == 'JPEG':
+            format_, ext = 'JPEG', '.jpeg'
+            options['quality'] = self.quality
+            if image.mode not in ('RGB', 'L', 'CMYK'):
+                image = image.convert('RGB')
+        else:
+            format_, ext = 'PNG', '.png'
+            if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                image = image.convert('RGBA')
+
+        if self.stripmetadata:
+            # Writers fall back to the metadata the image was read with
+            for name in ('exif', 'icc_profile'):
+                image.info.pop(name, None)
+        output = io.BytesIO()
+        image.save(output, format_, **options)
+        optimized = output.getvalue()
+        if not resized and len(optimized) >= len(data):
+            return data, _imageinfo(data)[0]
+        return optimized, ext
+
+    def clear(self):
+        '''Drop all optimized images and reset the counters'''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _newzipinfo(path, level):
+    '''Return the ZipInfo of a part compressed at level, 0 storing it'''
+    zinfo = zipfile.ZipInfo(path, time.localtime(time.time())[:6])
+    # What ZipFile.writestr() gives
+    zinfo.external_attr = 0o600 << 16
+    zinfo.compress_type = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+    return zinfo
+
+
+class CompressionPolicy(object):
+    ''' How the parts of a saved document are compressed
+
+    Parts are deflated at level, unless their path or extension is in
+    levels. Level 0 stores a part as it is, and so do the extensions in
+    store, which are already compressed. Level 1 is the fastest, 9 gives
+    the smallest file.
+
+    With threads, the parts are deflated in a pool of that many threads
+    before being written. zlib releases the GIL, so this pays off for
+    documents with large parts. Parts that are copied unchanged from the
+    template keep the compression they have there.
+    '''
+
+    def __init__(self, level=6, levels=None, store=None, threads=0):
+        '''
+        @param int level:   Deflate level, 0 to 9
+        @param dict levels: Level by part path or extension, such as
+                            {'word/document.xml': 9, '.xml': 1}
+        @param list store:  Extensions of parts to store uncompressed,
+                            Docx.compressedmedia by default
+        @param int threads: Threads to compress parts in, 0 for none
+        '''
+        self.level = level
+        self.levels = dict(levels or {})
+        self.store = set(Docx.compressedmedia if store is None else store)
+        self.threads = threads
+
+    def levelfor(self, path):
+        '''Return the level to compress the part at path with'''
+        level = self.levels.get(path)
+        if level is not None:
+            return level
+        extension = os.path.splitext(path)[1].lower()
+        if extension in self.store:
+            return 0
+        return self.levels.get(extension, self.level)
+
+    def compress(self, path, data):
+        '''Return the ZipInfo and compressed data of a part'''
+        level = self.levelfor(path)
+        zinfo = _newzipinfo(path, level)
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        zinfo.file_size = len(data)
+        if level:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        return zinfo, data
+
+    def write(self, docxfile, parts):
+        '''Compress and add (path, data) parts to docxfile, in order'''
+        if self.threads and len(parts) > 1:
+            pool = multiprocessing.pool.ThreadPool(self.threads)
+            try:
+                compressed = pool.map(lambda part: self.compress(*part),
+                                      parts, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            compressed = [self.compress(path, data) for path, data in parts]
+        for zinfo, data in compressed:
+            _writerawmember(docxfile, zinfo, data)
+
+
+class _ZipMemberWriter(object):
+    ''' File object that writes a single zip member
+
+    The content is deflated as it is written and spooled, to memory and
+    then to a temporary file for large members. zipfile can't write members
+    of unknown size with our compression level into a file, so the member
+    is only added on close.
+    '''
+
+    def __init__(self, docxfile, path, level=6):
+        self._docxfile = docxfile
+        self._zinfo = _newzipinfo(path, level)
+        self._zinfo.CRC = 0
+        self._zinfo.file_size = 0
+        self._compressor = None
+        if level:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self._spool = tempfile.SpooledTemporaryFile(max_size=1 << 22)
+
+    def write(self, data):
+        zinfo = self._zinfo
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+        zinfo.file_size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._spool.write(data)
+
+    def close(self):
+        try:
+            if self._compressor is not None:
+                self._spool.write(self._compressor.flush())
+            self._zinfo.compress_size = self._spool.tell()
+            self._spool.seek(0)
+            _writerawmember(self._docxfile, self._zinfo, source=self._spool)
+        finally:
+            self._spool.close()
+
+class _TextIndex(object):
+    ''' Document ordered list of the w:t elements of a document
+
+    The elements builders append to the body are added with add(), but only
+    searched for text elements when the index is next used. So changes made
+    to a returned element before then are picked up. An element may be added
+    again once it is moved into another, such as a paragraph put in a table
+    cell; its text elements are still only listed once, where they were
+    first found.
+    '''
+
+    tag = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t'
+
+    def __init__(self, root):
+        self._nodes = list(root.iter(self.tag))
+        self._indexed = set(self._nodes)
+        self._pending = []
+
+    def add(self, element):
+        self._pending.append(element)
+
+    def nodes(self):
+        '''Return the w:t elements in document order'''
+        if self._pending:
+            for element in self._pending:
+                if element.getparent() is None:
+                    # Removed again before we got to it
+                    continue
+                for node in element.iter(self.tag):
+                    if node not in self._indexed:
+                        self._indexed.add(node)
+                        self._nodes.append(node)
+            del self._pending[:]
+        return self._nodes
+
+
+class _ClarkNames(dict):
+    ''' Table of 'prefix:name' to Clark notation '{namespace}name'
+
+    Names are worked out on first use and then just looked up, so builders
+    can use qn['w:p'] instead of putting the tag together on every call.
+    '''
+
+    def __init__(self, nsprefixes):
+        dict.__init__(self)
+        self.namespaces = dict(nsprefixes)
+        self.namespaces['xml'] = 'http://www.w3.org/XML/1998/namespace'
+
+    def __missing__(self, name):
+        prefix, localname = name.split(':', 1)
+        clark = '{%s}%s' % (self.namespaces[prefix], localname)
+        self[name] = clark
+        return clark
+
+
+# Most precise clock for timing phases
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class _Phase(object):
+    ''' A timed phase of the work on a document, see Docx.instrument '''
+
+    def __init__(self, docx, name, instrument):
+        self.docx = docx
+        self.name = name
+        self.instrument = instrument
+        self.stats = {}
+        self.start = None
+
+    def __enter__(self):
+        self.docx._phases.append(self)
+        self.instrument(self.docx, 'start', self.name, self.stats)
+        self.start = _timer()
+        return self
+
+    def __exit__(self, *excinfo):
+        self.stats['seconds'] = _timer() - self.start
+        self.docx._phases.pop()
+        self.instrument(self.docx, 'end', self.name, self.stats)
+
+
+class _NoPhase(object):
+    ''' Stands in for _Phase when instrumentation is off '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excinfo):
+        pass
+
+
+_nophase = _NoPhase()
+
+
+def _instrumented(name):
+    '''Decorate a Docx method to report its calls as phase name'''
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            instrument = self._instrument()
+            if instrument is None:
+                return method(self, *args, **kwargs)
+            with _Phase(self, name, instrument):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class PhaseCollector(object):
+    ''' Instrument that adds up the phases of any number of documents
+
+    Set it as Docx.instrument, or pass it to Docx(), then read report().
+    The time of a phase includes the phases run inside it, such as loaddocx
+    in load or serialize in save. Numeric stats are summed per phase, and
+    the compressed bytes of the parts written are summed per part.
+    '''
+
+    def __init__(self):
+        # phase -> {'count': n, 'seconds': total, 'min': s, 'max': s, stat: sum}
+        self.phases = {}
+        # part path -> compressed bytes
+        self.parts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, docx, event, phase, stats):
+        if event != 'end':
+            return
+        seconds = stats['seconds']
+        with self._lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = {
+                    'count': 0, 'seconds': 0.0, 'min': seconds, 'max': seconds}
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['min'] = min(totals['min'], seconds)
+            totals['max'] = max(totals['max'], seconds)
+            for name, value in stats.items():
+                if name == 'parts':
+                    for part, size in value.items():
+                        self.parts[part] = self.parts.get(part, 0) + size
+                elif name != 'seconds' and isinstance(value, (int, float)):
+                    # Flags such as 'cached' add up to a count
+                    totals[name] = totals.get(name, 0) + value
+
+    def report(self):
+        '''Return the totals per phase, with the mean time of each, and
+        the compressed bytes per part'''
+        with self._lock:
+            phases = {}
+            for phase, totals in self.phases.items():
+                phases[phase] = dict(totals)
+                phases[phase]['mean'] = totals['seconds'] / totals['count']
+            return {'phases': phases, 'parts': dict(self.parts)}
+
+    def reset(self):
+        '''Forget everything collected so far'''
+        with self._lock:
+            self.phases.clear()
+            self.parts.clear()
+
+
 class Docx(object):
     ''' Open Docx Library
     
@@ -28,7 +1164,8 @@ class Docx(object):
     templates to be provided. Basically, you start with a template and then
     add the content.
     
-    1) Provide a template, this is an existing word document.
+    1) Provide a template, this is an existing word document. It may be
+       given as a path, as its data or as a file object.
     2) Call methods to add content to the document.
     3) Save the document.
     
@@ -36,6 +1173,27 @@ class Docx(object):
     
     # The default template
     __templatePath = os.path.join(os.path.dirname(__file__), 'template.docx')
+
+    # Parsed templates shared by all instances, see TemplateCache
+    templatecache = templatecache
+    
+    # Paragraph and run properties shared by all instances, see PrototypeCache
+    prototypecache = prototypecache
+    
+    # Used by picture() when asked to optimize, see ImageOptimizer
+    imageoptimizer = ImageOptimizer()
+    
+    # Called as instrument(docx, event, phase, stats) when a phase of the work
+    # on a document starts and ends, event being 'start' or 'end'. stats is
+    # a dict holding 'seconds' and sizes such as 'elements' or 'bytes' at
+    # the end. See PhaseCollector. None turns instrumentation off.
+    instrument = None
+    
+    # Media formats that are already compressed, these are stored as they are
+    compressedmedia = ['.png', '.jpg', '.jpeg', '.gif', '.wdp']
+    
+    # Default CompressionPolicy of savedocx(), None to deflate at level 6
+    compression = None
     
     # All Word prefixes / namespace matches used in document.xml & core.xml.
     # LXML doesn't actually use prefixes (just the real namespace) , but these
@@ -73,86 +1231,158 @@ class Docx(object):
         'dcmitype': 'http://purl.org/dc/dcmitype/',
         'dcterms':  'http://purl.org/dc/terms/'}
     
+    # Clark notation names, qn['w:p'] is '{<w namespace>}p'
+    qn = _ClarkNames(nsprefixes)
     
-    def __init__(self, template=None):
-        self._relationshiplist = {}
+    
+    def __init__(self, template=None, cache=True, normalize=False,
+                 instrument=None, usemmap=False):
+        '''
+        @param mixed template:   Path of the template, its data or a file
+                                 object, None for the default template
+        @param bool cache:       Share the parsed template through
+                                 templatecache. Templates given as data
+                                 aren't cached.
+        @param bool normalize:   Run normalize() once the template is loaded
+        @param mixed instrument: See Docx.instrument
+        @param bool usemmap:     Map a template on disk into memory rather
+                                 than reading it through a file
+        
+        The template stays open while media may still be read from it. Use
+        close(), or the document as a context manager, to close a template
+        that isn't cached as soon as the document is done with.
+        '''
+        if instrument is not None:
+            self.instrument = instrument
+        # Phases in progress, innermost last
+        self._phases = []
+        self._relationships = None
         self._document = None
-        self._template = template if template else self.__templatePath
+        # A parsed template shared by the caller, see AsyncRenderer
+        shared = template if isinstance(template, _Template) else None
+        if shared is not None:
+            self._template = shared.path or shared.package._data
+        else:
+            self._template = _templatesource(template if template
+                                             else self.__templatePath)
         self._media = {}
         self._coreprops = None
         self._appprops = None
         self._contentTypes = None
         self._webSettings = None
+        self._stream = None
+        # Built on first use, see _gettextindex()
+        self._textindex = None
+        # Text elements emptied since the last clean()
+        self._dirty = []
+        # Names of inserted images by sha1 of their data
+        self._pictures = {}
+        self._lastdrawingid = None
         
-        if not os.path.isfile(self._template):
+        if not _iszipdata(self._template) and not os.path.isfile(self._template):
             raise Exception("template docx |%s|not found" % self._template)
         
-        self._loaddocx()
-        self._loadrels()
-        self._loadmedia()
-        self.coreproperties('none', 'none', 'none', '')
-        self._initAppProps()
-        self._initContentTypes()
-        self._initWebSettings()
-    
+        with self._phase('load'):
+            with self._phase('template'):
+                self._ownstemplate = shared is None and (
+                    not cache or _iszipdata(self._template))
+                if shared is not None:
+                    self._templatedata = shared
+                    self._stat('cached', True)
+                elif not self._ownstemplate:
+                    misses = self.templatecache.misses
+                    self._templatedata = self.templatecache.get(self._template,
+                                                                usemmap)
+                    self._stat('cached', misses == self.templatecache.misses)
+                else:
+                    self._templatedata = _Template(self._template, usemmap)
+                    self._stat('cached', False)
+            
+            self._loaddocx()
+            if normalize:
+                self.normalize()
+            self._loadrels()
+            self._loadmedia()
+            self.coreproperties('none', 'none', 'none', '')
+            self._initAppProps()
+            self._initContentTypes()
+            self._initWebSettings()
+    
+    def close(self):
+        '''Close the template, unless templatecache shares it
+        
+        The document can still be saved, which opens the template again.
+        '''
+        if self._ownstemplate:
+            self._templatedata.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *excinfo):
+        self.close()
+    
+    def _instrument(self):
+        '''Return instrument as it was set, a function set on the class
+        isn't made a method'''
+        if 'instrument' in self.__dict__:
+            return self.__dict__['instrument']
+        for cls in type(self).__mro__:
+            if 'instrument' in cls.__dict__:
+                instrument = cls.__dict__['instrument']
+                if isinstance(instrument, (staticmethod, classmethod)):
+                    instrument = instrument.__get__(self, cls)
+                return instrument
+    
+    def _phase(self, name):
+        '''Return a context manager timing phase name when instrumented'''
+        instrument = self._instrument()
+        if instrument is None:
+            return _nophase
+        return _Phase(self, name, instrument)
+    
+    def _stat(self, name, value):
+        '''Record a stat of the current phase, if instrumented'''
+        if self._phases:
+            self._phases[-1].stats[name] = value
+    
+    @_instrumented('loaddocx')
     def _loaddocx(self):
         '''Load the core document content into our xml "document" '''
-
-        documentPath = 'word/document.xml'
-        zf = zipfile.ZipFile(self._template)
-        xmlcontent = zf.read(documentPath)
-        self._document = etree.fromstring(xmlcontent)
+        self._document = copy.deepcopy(self._templatedata.document)
         self._docbody = self._document.xpath('/w:document/w:body',
                                              namespaces=self.nsprefixes)[0]
+        if self._phases:
+            self._stat('elements', sum(1 for element in self._document.iter()))
     
+    @_instrumented('loadrels')
     def _loadrels(self):
         '''Load the relationships content into our relationship list '''
-        rl = {}
-
-        relsPath = 'word/_rels/document.xml.rels'
-        zf = zipfile.ZipFile(self._template)
-        if relsPath in zf.namelist():
-          
-            xmlcontent = zf.read(relsPath)
-            rels = etree.fromstring(xmlcontent)
-            
-            for node in rels.getchildren():
-                id_ = int(node.get('Id')[3:])
-                rl[id_] = [node.get('Type'), node.get('Target')]
+        if self._templatedata.relsPath in self._templatedata.parts:
+            rl = self._templatedata.relationships.copy()
         
         else:
             # Fallback for when we're using the v0.2.1 version of the
             # default template
-            rl = \
-                {1: ['http://schemas.openxmlformats.org/officeDocument/2006/'
-                  'relationships/numbering', 'numbering.xml'],
-                 2: ['http://schemas.openxmlformats.org/officeDocument/2006/'
-                  'relationships/styles', 'styles.xml'],
-                 3: ['http://schemas.openxmlformats.org/officeDocument/2006/'
-                  'relationships/settings', 'settings.xml'],
-                 4: ['http://schemas.openxmlformats.org/officeDocument/2006/'
-                  'relationships/webSettings', 'webSettings.xml'],
-                 5: ['http://schemas.openxmlformats.org/officeDocument/2006/'
-                  'relationships/fontTable', 'fontTable.xml'],
-                 6: ['http://schemas.openxmlformats.org/officeDocument/2006/'
-                  'relationships/theme', 'theme/theme1.xml']}
+            rl = _Relationships()
+            for reltype, target in [
+                    ('numbering', 'numbering.xml'),
+                    ('styles', 'styles.xml'),
+                    ('settings', 'settings.xml'),
+                    ('webSettings', 'webSettings.xml'),
+                    ('fontTable', 'fontTable.xml'),
+                    ('theme', 'theme/theme1.xml')]:
+                rl.add('http://schemas.openxmlformats.org/officeDocument/2006/'
+                       'relationships/' + reltype, target)
                 
-        self._relationshiplist = rl
+        self._relationships = rl
+        self._stat('relationships', len(rl))
     
+    @_instrumented('loadmedia')
     def _loadmedia(self):
-        '''Load the relationships content into our relationship list '''
-        zf = zipfile.ZipFile(self._template)
-        media = {}
-        prefix = 'word/media'
-        for zipInfo in zf.infolist():
-            name = zipInfo.filename
-            if not name.startswith(prefix):
-                continue
-            
-            name = name[len(prefix) + 1:]
-            media[name] = zf.read(zipInfo.filename)
-            
-        self._media = media
+        '''Set up our media, template media is read when it's needed '''
+        self._media = _MediaStore(self._templatedata)
+        self._stat('media', len(self._media))
         
     def _initAppProps(self):
         """
@@ -161,10 +1391,10 @@ class Docx(object):
     
         """
         appprops = etree.fromstring(
-            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Properties x'
-            'mlns="http://schemas.openxmlformats.org/officeDocument/2006/extended'
-            '-properties" xmlns:vt="http://schemas.openxmlformats.org/officeDocum'
-            'ent/2006/docPropsVTypes"></Properties>')
+            b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Properties x'
+            b'mlns="http://schemas.openxmlformats.org/officeDocument/2006/extended'
+            b'-properties" xmlns:vt="http://schemas.openxmlformats.org/officeDocum'
+            b'ent/2006/docPropsVTypes"></Properties>')
         props = \
             {'Template':             'Normal.dotm',
              'TotalTime':            '6',
@@ -215,10 +1445,13 @@ class Docx(object):
                                                  'ContentType': parts[part]}))
         # Add support for filetypes
         filetypes = {
+            'bmp':  'image/bmp',
             'gif':  'image/gif',
             'jpeg': 'image/jpeg',
             'jpg':  'image/jpeg',
             'png':  'image/png',
+            'tif':  'image/tiff',
+            'tiff': 'image/tiff',
             'rels': 'application/vnd.openxmlformats-package.relationships+xml',
             'xml':  'application/xml'
         }
@@ -251,11 +1484,11 @@ class Docx(object):
             # FIXME: rest of code below expects a single prefix
             nsprefix = nsprefix[0]
         if nsprefix:
-            namespace = '{' + self.nsprefixes[nsprefix] + '}'
+            tag = self.qn[nsprefix + ':' + tagname]
         else:
             # For when namespace = None
-            namespace = ''
-        newelement = etree.Element(namespace + tagname, nsmap=namespacemap)
+            tag = tagname
+        attrib = None
         # Add attributes with namespaces
         if attributes:
             # If they haven't bothered setting attribute namespace, use an empty
@@ -264,20 +1497,20 @@ class Docx(object):
                 # Quick hack: it seems every element that has a 'w' nsprefix for
                 # its tag uses the same prefix for it's attributes
                 if nsprefix == 'w':
-                    attributenamespace = namespace
-                else:
-                    attributenamespace = ''
+                    attrnsprefix = 'w'
+            if attrnsprefix:
+                qn = self.qn
+                attrib = dict((qn[attrnsprefix + ':' + name], value)
+                              for name, value in attributes.items())
             else:
-                attributenamespace = '{' + self.nsprefixes[attrnsprefix] + '}'
-    
-            for tagattribute in attributes:
-                newelement.set(attributenamespace + tagattribute,
-                               attributes[tagattribute])
+                attrib = attributes
+        newelement = etree.Element(tag, attrib, nsmap=namespacemap)
         if tagtext:
             newelement.text = tagtext
         return newelement
     
     
+    @_instrumented('pagebreak')
     def pagebreak(self, type='page', orient='portrait'):
         '''Insert a break, default 'page'.
         See http://openxmldeveloper.org/forums/thread/4075.aspx
@@ -287,27 +1520,27 @@ class Docx(object):
         if type not in validtypes:
             tmpl = 'Page break style "%s" not implemented. Valid styles: %s.'
             raise ValueError(tmpl % (type, validtypes))
-        pagebreak = self._makeelement('p')
+        qn = self.qn
+        SubElement = etree.SubElement
+        pagebreak = etree.Element(qn['w:p'])
         if type == 'page':
-            run = self._makeelement('r')
-            br = self._makeelement('br', attributes={'type': type})
-            run.append(br)
-            pagebreak.append(run)
+            run = SubElement(pagebreak, qn['w:r'])
+            SubElement(run, qn['w:br'], {qn['w:type']: type})
         elif type == 'section':
-            pPr = self._makeelement('pPr')
-            sectPr = self._makeelement('sectPr')
+            pPr = SubElement(pagebreak, qn['w:pPr'])
+            sectPr = SubElement(pPr, qn['w:sectPr'])
             if orient == 'portrait':
-                pgSz = self._makeelement('pgSz', attributes={'w': '12240', 'h': '15840'})
+                SubElement(sectPr, qn['w:pgSz'], {qn['w:w']: '12240',
+                                                  qn['w:h']: '15840'})
             elif orient == 'landscape':
-                pgSz = self._makeelement('pgSz', attributes={'h': '12240', 'w': '15840',
-                                                       'orient': 'landscape'})
-            sectPr.append(pgSz)
-            pPr.append(sectPr)
-            pagebreak.append(pPr)
+                SubElement(sectPr, qn['w:pgSz'], {qn['w:h']: '12240',
+                                                  qn['w:w']: '15840',
+                                                  qn['w:orient']: 'landscape'})
             
-        self._docbody.append(pagebreak)
+        self._appendbody(pagebreak)
     
     
+    @_instrumented('paragraph')
     def paragraph(self, paratext, style='BodyText', breakbefore=False, jc='left'):
         """
         Return a new paragraph element containing *paratext*. The paragraph's
@@ -330,77 +1563,94 @@ class Docx(object):
                 ('some italic underlined text', 'iu')
             ]
         """
-        # Make our elements
-        paragraph = self._makeelement('p')
+        paragraph = self._makeparagraph(paratext, style, breakbefore, jc)
+        self._appendbody(paragraph)
+        return paragraph
     
+    
+    def _makeparagraph(self, paratext, style='BodyText', breakbefore=False,
+                       jc='left'):
+        '''Return a new paragraph element without adding it to the body'''
         if not isinstance(paratext, list):
             paratext = [(paratext, '')]
-        text_tuples = []
+        qn = self.qn
+        SubElement = etree.SubElement
+        prototypes = self.prototypecache
+        # Make our elements
+        paragraph = etree.Element(qn['w:p'])
+        paragraph.append(prototypes.get(('pPr', style, jc), self._makepPr,
+                                        style, jc))
+    
+        # Add the text to the run, and the run to the paragraph
         for pt in paratext:
             text, char_styles_str = (pt if isinstance(pt, (list, tuple))
                                      else (pt, ''))
-            text_elm = self._makeelement('t', tagtext=text)
-            if len(text.strip()) < len(text):
-                text_elm.set('{http://www.w3.org/XML/1998/namespace}space',
-                             'preserve')
-            text_tuples.append([text_elm, char_styles_str])
-        pPr = self._makeelement('pPr')
-        pStyle = self._makeelement('pStyle', attributes={'val': style})
-        pJc = self._makeelement('jc', attributes={'val': jc})
-        pPr.append(pStyle)
-        pPr.append(pJc)
-    
-        # Add the text to the run, and the run to the paragraph
-        paragraph.append(pPr)
-        for text_elm, char_styles_str in text_tuples:
-            run = self._makeelement('r')
-            rPr = self._makeelement('rPr')
+            run = SubElement(paragraph, qn['w:r'])
             # Apply styles
-            if 'b' in char_styles_str:
-                b = self._makeelement('b')
-                rPr.append(b)
-            if 'i' in char_styles_str:
-                i = self._makeelement('i')
-                rPr.append(i)
-            if 'u' in char_styles_str:
-                u = self._makeelement('u', attributes={'val': 'single'})
-                rPr.append(u)
-            run.append(rPr)
+            formats = ('b' in char_styles_str, 'i' in char_styles_str,
+                       'u' in char_styles_str)
+            run.append(prototypes.get(('rPr',) + formats, self._makerPr,
+                                      *formats))
             # Insert lastRenderedPageBreak for assistive technologies like
             # document narrators to know when a page break occurred.
             if breakbefore:
-                lastRenderedPageBreak = self._makeelement('lastRenderedPageBreak')
-                run.append(lastRenderedPageBreak)
-            run.append(text_elm)
-            paragraph.append(run)
-        # Return the combined paragraph
-        self._docbody.append(paragraph)
+                SubElement(run, qn['w:lastRenderedPageBreak'])
+            text_elm = SubElement(run, qn['w:t'])
+            if text:
+                text_elm.text = text
+            if len(text.strip()) < len(text):
+                text_elm.set(qn['xml:space'], 'preserve')
         return paragraph
     
     
+    def _makepPr(self, style, jc=None):
+        '''Return paragraph properties setting style and justification'''
+        qn = self.qn
+        pPr = etree.Element(qn['w:pPr'])
+        etree.SubElement(pPr, qn['w:pStyle'], {qn['w:val']: style})
+        if jc is not None:
+            etree.SubElement(pPr, qn['w:jc'], {qn['w:val']: jc})
+        return pPr
+    
+    
+    def _makerPr(self, bold=False, italic=False, underline=False):
+        '''Return run properties for the given character formatting'''
+        qn = self.qn
+        rPr = etree.Element(qn['w:rPr'])
+        if bold:
+            etree.SubElement(rPr, qn['w:b'])
+        if italic:
+            etree.SubElement(rPr, qn['w:i'])
+        if underline:
+            etree.SubElement(rPr, qn['w:u'], {qn['w:val']: 'single'})
+        return rPr
+    
+    
     def contenttypes(self):
         return self._contentTypes
     
     
+    @_instrumented('heading')
     def heading(self, headingtext, headinglevel, lang='en'):
         '''Make a new heading, return the heading element'''
         lmap = {'en': 'Heading', 'it': 'Titolo'}
+        qn = self.qn
+        SubElement = etree.SubElement
         # Make our elements
-        paragraph = self._makeelement('p')
-        pr = self._makeelement('pPr')
-        pStyle = self._makeelement(
-            'pStyle', attributes={'val': lmap[lang] + str(headinglevel)})
-        run = self._makeelement('r')
-        text = self._makeelement('t', tagtext=headingtext)
+        paragraph = etree.Element(qn['w:p'])
+        style = lmap[lang] + str(headinglevel)
+        paragraph.append(self.prototypecache.get(('pPr', style, None),
+                                                 self._makepPr, style))
         # Add the text the run, and the run to the paragraph
-        pr.append(pStyle)
-        run.append(text)
-        paragraph.append(pr)
-        paragraph.append(run)
+        run = SubElement(paragraph, qn['w:r'])
+        text = SubElement(run, qn['w:t'])
+        if headingtext:
+            text.text = headingtext
         # Return the combined paragraph
-        self._docbody.append(paragraph)
+        self._appendbody(paragraph)
     
     
+    @_instrumented('table')
     def table(self, contents, heading=True, colw=None, cwunit='dxa', tblw=0,
               twunit='auto', borders={}, celstyle=None):
         """
@@ -440,86 +1690,23 @@ class Docx(object):
                                         documentation.
         @return lxml.etree:   Generated XML etree element
         """
-        table = self._makeelement('tbl')
+        qn = self.qn
+        SubElement = etree.SubElement
         columns = len(contents[0])
-        # Table properties
-        tableprops = self._makeelement('tblPr')
-        tablestyle = self._makeelement('tblStyle', attributes={'val': ''})
-        tableprops.append(tablestyle)
-        tablewidth = self._makeelement(
-            'tblW', attributes={'w': str(tblw), 'type': str(twunit)})
-        tableprops.append(tablewidth)
-        if len(borders.keys()):
-            tableborders = self._makeelement('tblBorders')
-            for b in ['top', 'left', 'bottom', 'right', 'insideH', 'insideV']:
-                if b in borders.keys() or 'all' in borders.keys():
-                    k = 'all' if 'all' in borders.keys() else b
-                    attrs = {}
-                    for a in borders[k].keys():
-                        attrs[a] = unicode(borders[k][a])
-                    borderelem = self._makeelement(b, attributes=attrs)
-                    tableborders.append(borderelem)
-            tableprops.append(tableborders)
-        tablelook = self._makeelement('tblLook', attributes={'val': '0400'})
-        tableprops.append(tablelook)
-        table.append(tableprops)
-        # Table Grid
-        tablegrid = self._makeelement('tblGrid')
-        for i in range(columns):
-            attrs = {'w': str(colw[i]) if colw else '2390'}
-            tablegrid.append(self._makeelement('gridCol', attributes=attrs))
-        table.append(tablegrid)
-        # Heading Row
-        row = self._makeelement('tr')
-        rowprops = self._makeelement('trPr')
-        cnfStyle = self._makeelement('cnfStyle', attributes={'val': '000000100000'})
-        rowprops.append(cnfStyle)
-        row.append(rowprops)
+        table = self._maketableshell(columns, colw, tblw, twunit, borders)
+        cellwidths, aligns = self._tablecolumns(columns, colw, cwunit,
+                                                celstyle)
         if heading:
-            i = 0
-            for heading in contents[0]:
-                cell = self._makeelement('tc')
-                # Cell properties
-                cellprops = self._makeelement('tcPr')
-                if colw:
-                    wattr = {'w': str(colw[i]), 'type': cwunit}
-                else:
-                    wattr = {'w': '0', 'type': 'auto'}
-                cellwidth = self._makeelement('tcW', attributes=wattr)
-                cellstyle = self._makeelement('shd', attributes={'val': 'clear',
-                                                           'color': 'auto',
-                                                           'fill': 'FFFFFF',
-                                                           'themeFill': 'text2',
-                                                           'themeFillTint': '99'})
-                cellprops.append(cellwidth)
-                cellprops.append(cellstyle)
-                cell.append(cellprops)
-                # Paragraph (Content)
-                if not isinstance(heading, (list, tuple)):
-                    heading = [heading]
-                for h in heading:
-                    if isinstance(h, etree._Element):
-                        cell.append(h)
-                    else:
-                        cell.append(self.paragraph(h, jc='center'))
-                row.append(cell)
-                i += 1
-            table.append(row)
+            table.append(self._makeheadingrow(contents[0], cellwidths))
         # Contents Rows
         for contentrow in contents[1 if heading else 0:]:
-            row = self._makeelement('tr')
+            row = SubElement(table, qn['w:tr'])
             i = 0
             for content in contentrow:
-                cell = self._makeelement('tc')
+                cell = SubElement(row, qn['w:tc'])
                 # Properties
-                cellprops = self._makeelement('tcPr')
-                if colw:
-                    wattr = {'w': str(colw[i]), 'type': cwunit}
-                else:
-                    wattr = {'w': '0', 'type': 'auto'}
-                cellwidth = self._makeelement('tcW', attributes=wattr)
-                cellprops.append(cellwidth)
-                cell.append(cellprops)
+                cellprops = SubElement(cell, qn['w:tcPr'])
+                SubElement(cellprops, qn['w:tcW'], cellwidths[i])
                 # Paragraph (Content)
                 if not isinstance(content, (list, tuple)):
                     content = [content]
@@ -527,208 +1714,553 @@ class Docx(object):
                     if isinstance(c, etree._Element):
                         cell.append(c)
                     else:
-                        if celstyle and 'align' in celstyle[i].keys():
-                            align = celstyle[i]['align']
-                        else:
-                            align = 'left'
-                        cell.append(self.paragraph(c, jc=align))
-                row.append(cell)
+                        cell.append(self._makeparagraph(c, jc=aligns[i]))
                 i += 1
-            table.append(row)
         
-        self._docbody.append(table)
+        self._appendbody(table)
+        return table
+    
+    
+    def _maketableshell(self, columns, colw=None, tblw=0, twunit='auto',
+                        borders={}):
+        '''Return a table element with its properties and grid, but no rows.
+        See table() for the parameters.'''
+        qn = self.qn
+        SubElement = etree.SubElement
+        val = qn['w:val']
+        table = etree.Element(qn['w:tbl'], nsmap={'w': self.nsprefixes['w']})
+        # Table properties
+        tableprops = SubElement(table, qn['w:tblPr'])
+        SubElement(tableprops, qn['w:tblStyle'], {val: ''})
+        SubElement(tableprops, qn['w:tblW'], {qn['w:w']: str(tblw),
+                                              qn['w:type']: str(twunit)})
+        if len(borders.keys()):
+            tableborders = SubElement(tableprops, qn['w:tblBorders'])
+            for b in ['top', 'left', 'bottom', 'right', 'insideH', 'insideV']:
+                if b in borders.keys() or 'all' in borders.keys():
+                    k = 'all' if 'all' in borders.keys() else b
+                    attrs = {}
+                    for a in borders[k].keys():
+                        attrs[qn['w:' + a]] = unicode(borders[k][a])
+                    SubElement(tableborders, qn['w:' + b], attrs)
+        SubElement(tableprops, qn['w:tblLook'], {val: '0400'})
+        # Table Grid
+        tablegrid = SubElement(table, qn['w:tblGrid'])
+        for i in range(columns):
+            SubElement(tablegrid, qn['w:gridCol'],
+                       {qn['w:w']: str(colw[i]) if colw else '2390'})
         return table
     
     
+    def _makeheadingrow(self, headings, cellwidths):
+        '''Return a shaded heading row holding headings, see table()'''
+        qn = self.qn
+        SubElement = etree.SubElement
+        val = qn['w:val']
+        row = etree.Element(qn['w:tr'], nsmap={'w': self.nsprefixes['w']})
+        rowprops = SubElement(row, qn['w:trPr'])
+        SubElement(rowprops, qn['w:cnfStyle'], {val: '000000100000'})
+        headingshading = {val: 'clear',
+                          qn['w:color']: 'auto',
+                          qn['w:fill']: 'FFFFFF',
+                          qn['w:themeFill']: 'text2',
+                          qn['w:themeFillTint']: '99'}
+        i = 0
+        for headingcell in headings:
+            cell = SubElement(row, qn['w:tc'])
+            # Cell properties
+            cellprops = SubElement(cell, qn['w:tcPr'])
+            SubElement(cellprops, qn['w:tcW'], cellwidths[i])
+            SubElement(cellprops, qn['w:shd'], headingshading)
+            # Paragraph (Content)
+            if not isinstance(headingcell, (list, tuple)):
+                headingcell = [headingcell]
+            for h in headingcell:
+                if isinstance(h, etree._Element):
+                    cell.append(h)
+                else:
+                    cell.append(self._makeparagraph(h, jc='center'))
+            i += 1
+        return row
+    
+    
+    def _tablecolumns(self, columns, colw=None, cwunit='dxa', celstyle=None):
+        '''Return the tcW attributes and the alignment of each column'''
+        qn = self.qn
+        cellwidths = []
+        aligns = []
+        for i in range(columns):
+            if colw:
+                cellwidths.append({qn['w:w']: str(colw[i]),
+                                   qn['w:type']: cwunit})
+            else:
+                cellwidths.append({qn['w:w']: '0', qn['w:type']: 'auto'})
+            if celstyle and 'align' in celstyle[i]:
+                aligns.append(celstyle[i]['align'])
+            else:
+                aligns.append('left')
+        return cellwidths, aligns
+    
+    
+    @_instrumented('bulktable')
+    def bulktable(self, rows, heading=None, columnar=False, colw=None,
+                  cwunit='dxa', tblw=0, twunit='auto', borders={},
+                  celstyle=None):
+        """
+        Add a table built from a large amount of data, return the table
+        element, or None when the document is being streamed.
+        
+        A prototype row holding a text cell for each column is built once,
+        each row of data is a copy of it with the text filled in. While
+        streaming (see startstream()) every row is written out as soon as it
+        is built, so rows can come from a generator and the table is never
+        held in memory.
+        
+        @param iterable rows:     The rows, each a sequence of cell values.
+                                  Values are strings, numbers or None for
+                                  an empty cell, or an etree element to put
+                                  in the cell as it is. Any iterable works,
+                                  including a 2D NumPy array.
+        @param mixed    heading:  Cell values of a heading row, or True to
+                                  make the first row the heading, as
+                                  table() does
+        @param bool     columnar: rows is a sequence of columns instead, such
+                                  as a list of lists or of NumPy arrays.
+        
+        The other parameters are the same as for table().
+        """
+        qn = self.qn
+        texttag = qn['w:t']
+        xmlspace = qn['xml:space']
+        
+        if columnar:
+            columns = len(rows)
+            rows = _izip(*rows)
+        else:
+            rows = iter(rows)
+        if heading is True:
+            try:
+                heading = next(rows)
+            except StopIteration:
+                raise ValueError('table has no rows')
+        elif heading is False:
+            heading = None
+        if not columnar:
+            if heading is not None:
+                columns = len(heading)
+            else:
+                try:
+                    first = next(rows)
+                except StopIteration:
+                    raise ValueError('table has no rows')
+                columns = len(first)
+                rows = itertools.chain([first], rows)
+        
+        table = self._maketableshell(columns, colw, tblw, twunit, borders)
+        cellwidths, aligns = self._tablecolumns(columns, colw, cwunit,
+                                                celstyle)
+        
+        # The prototype of every data row
+        prototype = etree.Element(qn['w:tr'], nsmap={'w': self.nsprefixes['w']})
+        for i in range(columns):
+            cell = etree.SubElement(prototype, qn['w:tc'])
+            cellprops = etree.SubElement(cell, qn['w:tcPr'])
+            etree.SubElement(cellprops, qn['w:tcW'], cellwidths[i])
+            cell.append(self._makeparagraph('', jc=aligns[i]))
+        
+        def makerow(values):
+            row = copy.deepcopy(prototype)
+            for text_elm, value in zip(list(row.iter(texttag)), values):
+                if value is None:
+                    continue
+                if isinstance(value, etree._Element):
+                    paragraph = text_elm.getparent().getparent()
+                    paragraph.getparent().replace(paragraph, value)
+                    continue
+                if not isinstance(value, basestring):
+                    value = unicode(value)
+                if value:
+                    text_elm.text = value
+                    if value[0].isspace() or value[-1].isspace():
+                        text_elm.set(xmlspace, 'preserve')
+            return row
+        
+        headingrow = None
+        if heading is not None:
+            headingrow = self._makeheadingrow(
+                [unicode(h) if not isinstance(h, (basestring, etree._Element))
+                 else h for h in heading], cellwidths)
+        
+        if not self._stream:
+            if headingrow is not None:
+                table.append(headingrow)
+            for values in rows:
+                table.append(makerow(values))
+            self._appendbody(table)
+            return table
+        
+        # Write the table out a row at a time
+        self._flushstream()
+        stream = self._stream
+        marker = etree.Comment('docx-table-rows')
+        table.append(marker)
+        xml = self._serializefragment(table, stream['decls'],
+                                      stream['prettyprint'])
+        prologue, epilogue = xml.split(etree.tostring(marker))
+        writer = stream['writer']
+        writer.write(prologue)
+        if headingrow is not None:
+            writer.write(self._serializefragment(headingrow, stream['decls'],
+                                                 stream['prettyprint']))
+        for values in rows:
+            writer.write(self._serializefragment(makerow(values),
+                                                 stream['decls'],
+                                                 stream['prettyprint']))
+        writer.write(epilogue)
+        return None
+    
+    
+    @_instrumented('picture')
     def picture(self, picfilepath,
             picdescription, pixelwidth=None,
             pixelheight=None, nochangeaspect=True, nochangearrowheads=True,
-            picname=None, overwrite=False, noscaleup=False):
+            picname=None, overwrite=False, noscaleup=False, optimize=None):
         """
         Take a relationshiplist, picture file name, and return a paragraph
         containing the image and an updated relationshiplist.
+        
+        picfilepath may also be a file object or the image data itself. The
+        same image data inserted again reuses the media part and relationship
+        of the first insertion, unless it is given another picname.
+        
+        optimize scales the image down to the size it is shown at before it
+        is embedded. It is an ImageOptimizer, or True to use imageoptimizer.
         """
         # http://openxmldeveloper.org/articles/462.aspx
         # Create an image. Size may be specified, otherwise it will based on the
         # pixel size of image. Return a paragraph containing the picture'''
         # Copy the file into the media dir
         
-        if not os.path.isfile(picfilepath):
-          raise Exception('|%s| is not a valid file' % picfilepath)
-        
-        if picname == None:
-          picname = os.path.basename(picfilepath)
-          
-        if not overwrite and picname in self._media:
-          raise Exception('picname |%s| is already in this document' % picname)
-          
-        self._media[picname] = open(picfilepath, 'rb+').read()
+        image = self._loadpicture(picfilepath, pixelwidth, pixelheight,
+                                  nochangeaspect, noscaleup)
+        optimizer = self._imageoptimizer(optimize)
+        optimized = None
+        if optimizer is not None:
+            optimized = optimizer.optimize(*image[:3])
+        self._insertpicture(image, optimized, picdescription, nochangeaspect,
+                            nochangearrowheads, picname, overwrite)
+    
+    
+    def _loadpicture(self, picfilepath, pixelwidth, pixelheight,
+                     nochangeaspect, noscaleup):
+        '''Return the data, display width and height, file name and
+        extension of a picture, see picture()'''
+        data, filename = _readimage(picfilepath)
+        ext, origwidth, origheight = _imageinfo(data)
         
         # Check if the user has specified a size
-        origwidth, origheight = Image.open(picfilepath).size[0:2]
-
-        if not pixelwidth and not pixelheight:
-            # If not, get info from the picture itself
-            pixelwidth = origwidth
-            pixelheight = origheight
+        pixelwidth, pixelheight = _displaysize(origwidth, origheight,
+                                               pixelwidth, pixelheight,
+                                               nochangeaspect, noscaleup)
+        return data, pixelwidth, pixelheight, filename, ext
+    
+    
+    def _insertpicture(self, image, optimized, picdescription, nochangeaspect,
+                       nochangearrowheads, picname, overwrite):
+        '''Add a picture loaded by _loadpicture(), see picture()
+        
+        @param tuple optimized: The (data, extension) an ImageOptimizer made
+                                of the image, or None
+        '''
+        data, pixelwidth, pixelheight, filename, ext = image
+        if optimized is not None:
+            optimized, ext = optimized
+            if optimized != data:
+                data = optimized
+                if filename and picname == None:
+                    # Keep the names of other sizes of the image apart
+                    picname = '%s-%dx%d%s' % (
+                        os.path.splitext(os.path.basename(filename))[0],
+                        pixelwidth, pixelheight, ext)
+        
+        digest = hashlib.sha1(data).hexdigest()
+        known = self._pictures.get(digest)
+        
+        if (known is not None and picname in (None, known)
+                and known in self._media):
+            picname = known
             
-        elif not pixelwidth:
-            pixelwidth = origwidth
-
-            if origheight < pixelheight and noscaleup:
-              pixelheight = origheight
+        else:
+            if picname == None:
+              if filename:
+                picname = os.path.basename(filename)
+              else:
+                picname = 'image-%s%s' % (digest[:16], ext)
               
-            elif nochangeaspect:
-                pixelwidth = pixelwidth * pixelheight / origheight
-            
-        elif not pixelheight:
-            pixelheight = origheight
-            
-            if origwidth < pixelwidth and noscaleup:
-              pixelwidth = origwidth
+            if not overwrite and picname in self._media:
+              raise Exception('picname |%s| is already in this document' % picname)
               
-            elif nochangeaspect:
-                pixelheight = pixelheight * pixelwidth / origwidth
-          
-    
+            # Forget the image this name held before
+            for olddigest, name in list(self._pictures.items()):
+                if name == picname:
+                    del self._pictures[olddigest]
+            
+            self._media[picname] = data
+            self._pictures[digest] = picname
+        
+        # Pictures of the same media share its relationship
+        picrelid = self._relationships.add(
+            ('http://schemas.openxmlformats.org/officeDocument/2006/relationship'
+             's/image'), 'media/' + picname)
     
         # OpenXML measures on-screen objects in English Metric Units
         # 1cm = 36000 EMUs
         emuperpixel = 12700
         width = str(pixelwidth * emuperpixel)
         height = str(pixelheight * emuperpixel)
-    
-        # Set relationship ID to the first available
-        picid = str(len(self._relationshiplist) + 1)
-        assert not picid in self._relationshiplist
         
-        picrelid = 'rId' + picid
-        self._relationshiplist[picid] = [
-            ('http://schemas.openxmlformats.org/officeDocument/2006/relationship'
-             's/image'), 'media/' + picname]
+        # Drawings need their own ids even when they share an image
+        picid = self._newdrawingid()
+    
+        qn = self.qn
+        SubElement = etree.SubElement
+        # The picture sits in an inline drawing in a run of its own paragraph
+        paragraph = etree.Element(qn['w:p'])
+        run = SubElement(paragraph, qn['w:r'])
+        drawing = SubElement(run, qn['w:drawing'])
+        inline = SubElement(drawing, qn['wp:inline'],
+                            {'distT': "0", 'distB': "0",
+                             'distL': "0", 'distR': "0"})
+        SubElement(inline, qn['wp:extent'], {'cx': width, 'cy': height})
+        SubElement(inline, qn['wp:effectExtent'],
+                   {'l': '25400', 't': '0', 'r': '0', 'b': '0'})
+        SubElement(inline, qn['wp:docPr'],
+                   {'id': picid, 'name': 'Picture 1',
+                    'descr': picdescription})
+        framepr = SubElement(inline, qn['wp:cNvGraphicFramePr'])
+        SubElement(framepr, qn['a:graphicFrameLocks'], {'noChangeAspect': '1'})
+        graphic = SubElement(inline, qn['a:graphic'])
+        graphicdata = SubElement(
+            graphic, qn['a:graphicData'],
+            {'uri': ('http://schemas.openxmlformats.org/drawingml/200'
+                     '6/picture')})
+        pic = SubElement(graphicdata, qn['pic:pic'])
     
         # There are 3 main elements inside a picture
-        # 1. The Blipfill - specifies how the image fills the picture area
+        # 1. The non visual picture properties
+        nvpicpr = SubElement(pic, qn['pic:nvPicPr'])
+        SubElement(nvpicpr, qn['pic:cNvPr'],
+                   {'id': '0', 'name': 'Picture 1', 'descr': picname})
+        cnvpicpr = SubElement(nvpicpr, qn['pic:cNvPicPr'])
+        SubElement(cnvpicpr, qn['a:picLocks'],
+                   {'noChangeAspect': str(int(nochangeaspect)),
+                    'noChangeArrowheads': str(int(nochangearrowheads))})
+    
+        # 2. The Blipfill - specifies how the image fills the picture area
         #    (stretch, tile, etc.)
-        blipfill = self._makeelement('blipFill', nsprefix='pic')
-        blipfill.append(self._makeelement('blip', nsprefix='a', attrnsprefix='r',
-                        attributes={'embed': picrelid}))
-        stretch = self._makeelement('stretch', nsprefix='a')
-        stretch.append(self._makeelement('fillRect', nsprefix='a'))
-        blipfill.append(self._makeelement('srcRect', nsprefix='a'))
-        blipfill.append(stretch)
-    
-        # 2. The non visual picture properties
-        nvpicpr = self._makeelement('nvPicPr', nsprefix='pic')
-        cnvpr = self._makeelement(
-            'cNvPr', nsprefix='pic',
-            attributes={'id': '0', 'name': 'Picture 1', 'descr': picname})
-        nvpicpr.append(cnvpr)
-        cnvpicpr = self._makeelement('cNvPicPr', nsprefix='pic')
-        cnvpicpr.append(self._makeelement(
-            'picLocks', nsprefix='a',
-            attributes={'noChangeAspect': str(int(nochangeaspect)),
-                        'noChangeArrowheads': str(int(nochangearrowheads))}))
-        nvpicpr.append(cnvpicpr)
+        blipfill = SubElement(pic, qn['pic:blipFill'])
+        SubElement(blipfill, qn['a:blip'], {qn['r:embed']: picrelid})
+        SubElement(blipfill, qn['a:srcRect'])
+        stretch = SubElement(blipfill, qn['a:stretch'])
+        SubElement(stretch, qn['a:fillRect'])
     
         # 3. The Shape properties
-        sppr = self._makeelement('spPr', nsprefix='pic', attributes={'bwMode': 'auto'})
-        xfrm = self._makeelement('xfrm', nsprefix='a')
-        xfrm.append(self._makeelement(
-            'off', nsprefix='a', attributes={'x': '0', 'y': '0'}))
-        xfrm.append(self._makeelement(
-            'ext', nsprefix='a', attributes={'cx': width, 'cy': height}))
-        prstgeom = self._makeelement(
-            'prstGeom', nsprefix='a', attributes={'prst': 'rect'})
-        prstgeom.append(self._makeelement('avLst', nsprefix='a'))
-        sppr.append(xfrm)
-        sppr.append(prstgeom)
-    
-        # Add our 3 parts to the picture element
-        pic = self._makeelement('pic', nsprefix='pic')
-        pic.append(nvpicpr)
-        pic.append(blipfill)
-        pic.append(sppr)
-    
-        # Now make the supporting elements
-        # The following sequence is just: make element, then add its children
-        graphicdata = self._makeelement(
-            'graphicData', nsprefix='a',
-            attributes={'uri': ('http://schemas.openxmlformats.org/drawingml/200'
-                                '6/picture')})
-        graphicdata.append(pic)
-        graphic = self._makeelement('graphic', nsprefix='a')
-        graphic.append(graphicdata)
-    
-        framelocks = self._makeelement('graphicFrameLocks', nsprefix='a',
-                                 attributes={'noChangeAspect': '1'})
-        framepr = self._makeelement('cNvGraphicFramePr', nsprefix='wp')
-        framepr.append(framelocks)
-        docpr = self._makeelement('docPr', nsprefix='wp',
-                            attributes={'id': picid, 'name': 'Picture 1',
-                                        'descr': picdescription})
-        effectextent = self._makeelement('effectExtent', nsprefix='wp',
-                                   attributes={'l': '25400', 't': '0', 'r': '0',
-                                               'b': '0'})
-        extent = self._makeelement('extent', nsprefix='wp',
-                             attributes={'cx': width, 'cy': height})
-        inline = self._makeelement('inline', attributes={'distT': "0", 'distB': "0",
-                                                   'distL': "0", 'distR': "0"},
-                             nsprefix='wp')
-        inline.append(extent)
-        inline.append(effectextent)
-        inline.append(docpr)
-        inline.append(framepr)
-        inline.append(graphic)
-        drawing = self._makeelement('drawing')
-        drawing.append(inline)
-        run = self._makeelement('r')
-        run.append(drawing)
-        paragraph = self._makeelement('p')
-        paragraph.append(run)
-        
-        self._docbody.append(paragraph)
+        sppr = SubElement(pic, qn['pic:spPr'], {'bwMode': 'auto'})
+        xfrm = SubElement(sppr, qn['a:xfrm'])
+        SubElement(xfrm, qn['a:off'], {'x': '0', 'y': '0'})
+        SubElement(xfrm, qn['a:ext'], {'cx': width, 'cy': height})
+        prstgeom = SubElement(sppr, qn['a:prstGeom'], {'prst': 'rect'})
+        SubElement(prstgeom, qn['a:avLst'])
+        
+        self._appendbody(paragraph)
+    
+    
+    @_instrumented('picture')
+    def picturemany(self, pictures, optimize=True):
+        '''Insert pictures, optimizing them in a thread pool first
+        
+        @param list pictures: dicts of picture() keyword arguments
+        @param mixed optimize: An ImageOptimizer, or True to use
+                               imageoptimizer
+        '''
+        optimizer = self._imageoptimizer(optimize)
+        images = []
+        for kwargs in pictures:
+            images.append(self._loadpicture(
+                kwargs['picfilepath'], kwargs.get('pixelwidth'),
+                kwargs.get('pixelheight'), kwargs.get('nochangeaspect', True),
+                kwargs.get('noscaleup', False)))
+        if optimizer is not None:
+            optimized = optimizer.optimizemany(image[:3] for image in images)
+        else:
+            optimized = [None] * len(images)
+        
+        for kwargs, image, result in _izip(pictures, images, optimized):
+            self._insertpicture(
+                image, result, kwargs['picdescription'],
+                kwargs.get('nochangeaspect', True),
+                kwargs.get('nochangearrowheads', True),
+                kwargs.get('picname'), kwargs.get('overwrite', False))
+    
+    
+    def _imageoptimizer(self, optimize):
+        '''Return the ImageOptimizer optimize stands for, or None'''
+        if optimize is True:
+            return self.imageoptimizer
+        if optimize is None or optimize is False:
+            return None
+        return optimize
+    
+    
+    def _newdrawingid(self):
+        '''Return the next free id for a drawing in the document'''
+        if self._lastdrawingid is None:
+            ids = self._document.xpath('//wp:docPr/@id',
+                                       namespaces=self.nsprefixes)
+            self._lastdrawingid = max([int(id_) for id_ in ids
+                                       if id_.isdigit()] or [0])
+        self._lastdrawingid += 1
+        return str(self._lastdrawingid)
+    
+    
+    def _gettextindex(self):
+        '''Return the index of text elements, building it if needed'''
+        if self._textindex is None:
+            self._textindex = _TextIndex(self._document)
+        return self._textindex
+    
+    
+    def reindex(self):
+        '''Rebuild the text index used by search and replace
+        
+        Only needed after elements holding text have been added to or removed
+        from the document tree directly, rather than with the methods here.
+        '''
+        self._textindex = None
     
     
+    @_instrumented('search')
     def search(self, search):
         '''Search a document for a regex, return success / fail result'''
-        result = False
         searchre = re.compile(search)
-        for element in self._document.iter():
-            if element.tag == '{%s}t' % self.nsprefixes['w']:  # t (text) elements
-                if element.text:
-                    if searchre.search(element.text):
-                        result = True
-        return result
+        for element in self._gettextindex().nodes():
+            if element.text:
+                if searchre.search(element.text):
+                    return True
+        return False
     
     
+    @_instrumented('replace')
     def replace(self, search, replace):
         """
         Replace all occurences of string with a different string, return updated
         document
         """
         searchre = re.compile(search)
-        for element in self._document.iter():
-            if element.tag == '{%s}t' % self.nsprefixes['w']:  # t (text) elements
-                if element.text:
-                    if searchre.search(element.text):
-                        element.text = re.sub(search, replace, element.text)
+        textindex = self._gettextindex()
+        for element in textindex.nodes():
+            if element.text:
+                if searchre.search(element.text):
+                    element.text = searchre.sub(replace, element.text)
+                    if not element.text:
+                        self._dirty.append(element)
     
     
-    def _clean(self):
+    @_instrumented('replace')
+    def replacemany(self, mapping):
+        """
+        Replace every occurence of each key of *mapping* with its value, in a
+        single pass over the document.
+        
+        Keys and values are plain strings, not regular expressions. Where keys
+        overlap the longest one wins. Like replace(), a key is only found when
+        it is inside a single text element.
+        
+        @param dict mapping: Placeholder to replacement text
+        
+        @return int          Number of replacements made
+        """
+        if not mapping:
+            return 0
+        if '' in mapping:
+            raise ValueError('replacemany() keys must not be empty')
+        keys = sorted(mapping, key=len, reverse=True)
+        searchre = re.compile('|'.join(re.escape(key) for key in keys))
+        count = [0]
+        
+        def substitute(match):
+            count[0] += 1
+            return mapping[match.group()]
+        
+        textindex = self._gettextindex()
+        for element in textindex.nodes():
+            if element.text:
+                text = searchre.sub(substitute, element.text)
+                if text != element.text:
+                    element.text = text
+                    if not text:
+                        self._dirty.append(element)
+        self._stat('replacements', count[0])
+        return count[0]
+    
+    
+    @_instrumented('clean')
+    def clean(self, full=False, mergeruns=False):
         """ Perform misc cleaning operations on documents.
             Returns cleaned document.
+        
+        Only the text elements emptied by the replace methods since the last
+        clean are visited, along with their runs. savedocx() does that much
+        on its own, call this for more before saving.
+        
+        @param bool full:      Scan the whole document for empty text
+                               elements and runs instead
+        @param bool mergeruns: Also merge adjacent runs with identical
+                               properties in the paragraphs visited
         """
-    
+        qn = self.qn
+        if full:
+            texts = list(self._document.iter(qn['w:t']))
+        else:
+            texts = self._dirty
+        self._dirty = []
+        
         # Clean empty text and r tags
-        for t in ('t', 'r'):
-            rmlist = []
-            for element in self._document.iter():
-                if element.tag == '{%s}%s' % (self.nsprefixes['w'], t):
-                    if not element.text and not len(element):
-                        rmlist.append(element)
-            for element in rmlist:
-                element.getparent().remove(element)
+        runs = []
+        for element in texts:
+            parent = element.getparent()
+            if parent is None or element.text or len(element):
+                # Already removed, or filled in again since
+                continue
+            parent.remove(element)
+            runs.append(parent)
+        if full:
+            runs = list(self._document.iter(qn['w:r']))
+        
+        changed = bool(runs)
+        paragraphs = []
+        for element in runs:
+            parent = element.getparent()
+            if parent is None:
+                continue
+            if not element.text and not [child for child in element
+                                         if child.tag != qn['w:rPr']]:
+                # Nothing left but the properties
+                parent.remove(element)
+            if mergeruns and not full:
+                paragraphs.append(parent)
+        
+        if mergeruns:
+            if full:
+                paragraphs = self._document.iter(qn['w:p'])
+            seen = set()
+            for paragraph in paragraphs:
+                if paragraph not in seen:
+                    seen.add(paragraph)
+                    changed = _mergeruns(paragraph) or changed
+        
+        if changed:
+            self._textindex = None
     
     
     def _findTypeParent(self, element, tag):
@@ -740,29 +2272,93 @@ class Docx(object):
         @return object element: the found parent or None when not found
         """
     
-        p = element
-        while True:
-            p = p.getparent()
+        p = element.getparent()
+        while p is not None:
             if p.tag == tag:
                 return p
+            p = p.getparent()
     
         # Not found
         return None
     
     
+    def _paragraphtexts(self):
+        """ Group the text elements of the document by paragraph
+    
+        @return list  A (paragraph, text elements, text start offsets) tuple
+                      for each paragraph holding text, in document order.
+        """
+        ptag = '{%s}p' % self.nsprefixes['w']
+        groups = []
+        paragraph = None
+        nodes = starts = None
+        length = 0
+        for node in self._gettextindex().nodes():
+            parent = node.getparent()
+            if parent is None or parent.getparent() is not paragraph:
+                p = self._findTypeParent(node, ptag)
+            else:
+                # Most runs sit straight in the paragraph
+                p = paragraph
+            if nodes is None or p is not paragraph:
+                paragraph = p
+                nodes = []
+                starts = []
+                length = 0
+                groups.append((paragraph, nodes, starts))
+            nodes.append(node)
+            starts.append(length)
+            length += len(node.text or '')
+        return groups
+    
+    
+    def _locate(self, starts, offset):
+        """Return the index of the text element holding character offset"""
+        return bisect.bisect_right(starts, offset) - 1
+    
+    
+    @_instrumented('normalize')
+    def normalize(self):
+        '''Merge the runs Word splits text into, so search and replace find
+        text as it reads
+        
+        Spelling and grammar marks, revision ids and rendering hints are
+        dropped, then adjacent runs with the same properties are merged.
+        
+        @return int  Number of runs merged away
+        '''
+        qn = self.qn
+        noise = list(self._document.iter(qn['w:proofErr'],
+                                         qn['w:lastRenderedPageBreak']))
+        for element in noise:
+            element.getparent().remove(element)
+        
+        prefix = qn['w:rsid']
+        for element in self._document.iter(qn['w:p'], qn['w:r'], qn['w:tr']):
+            for name in [name for name in element.attrib
+                         if name.startswith(prefix)]:
+                del element.attrib[name]
+        
+        merged = 0
+        for parent in self._document.iter(qn['w:p'], qn['w:hyperlink'],
+                                          qn['w:smartTag']):
+            merged += _mergeruns(parent)
+        if noise or merged:
+            self._textindex = None
+        return merged
+    
+    
+    @_instrumented('search')
     def AdvSearch(self, search, bs=3):
         '''Return set of all regex matches
     
-        This is an advanced version of python-docx.search() that takes into
-        account blocks of <bs> elements at a time.
+        This is an advanced version of python-docx.search() that finds text
+        spread over any number of text blocks of a paragraph.
     
         What it does:
-        It searches the entire document body for text blocks.
-        Since the text to search could be spawned across multiple text blocks,
-        we need to adopt some sort of algorithm to handle this situation.
-        The smaller matching group of blocks (up to bs) is then adopted.
-        If the matching group has more than one block, blocks other than first
-        are cleared and all the replacement text is put on first block.
+        The text of all the text blocks of each paragraph is joined together
+        once and the regexp is run over the joined text, so the time taken
+        grows linearly with the size of the document.
     
         Examples:
         original text blocks : [ 'Hel', 'lo,', ' world!' ]
@@ -776,7 +2372,8 @@ class Docx(object):
         @param instance  document: The original document
         @param str       search: The text to search for (regexp)
                               append, or a list of etree elements
-        @param int       bs: See above
+        @param int       bs: Unused, matches may span any number of blocks.
+                             Kept for compatibility.
     
         @return set      All occurences of search string
     
@@ -785,64 +2382,30 @@ class Docx(object):
         # Compile the search regexp
         searchre = re.compile(search)
     
-        matches = []
-    
-        # Will match against searchels. Searchels is a list that contains last
-        # n text elements found in the document. 1 < n < bs
-        searchels = []
-    
-        for element in self._document.iter():
-            if element.tag == '{%s}t' % self.nsprefixes['w']:  # t (text) elements
-                if element.text:
-                    # Add this element to searchels
-                    searchels.append(element)
-                    if len(searchels) > bs:
-                        # Is searchels is too long, remove first elements
-                        searchels.pop(0)
-    
-                    # Search all combinations, of searchels, starting from
-                    # smaller up to bigger ones
-                    # l = search lenght
-                    # s = search start
-                    # e = element IDs to merge
-                    found = False
-                    for l in range(1, len(searchels) + 1):
-                        if found:
-                            break
-                        for s in range(len(searchels)):
-                            if found:
-                                break
-                            if s + l <= len(searchels):
-                                e = range(s, s + l)
-                                txtsearch = ''
-                                for k in e:
-                                    txtsearch += searchels[k].text
-    
-                                # Searcs for the text in the whole txtsearch
-                                match = searchre.search(txtsearch)
-                                if match:
-                                    matches.append(match.group())
-                                    found = True
-        return set(matches)
+        matches = set()
+        for paragraph, nodes, starts in self._paragraphtexts():
+            text = ''.join([node.text or '' for node in nodes])
+            for match in searchre.finditer(text):
+                matches.add(match.group())
+        return matches
     
     
+    @_instrumented('replace')
     def advReplace(self, search, replace, bs=3):
         """
         Replace all occurences of string with a different string, return updated
         document
     
-        This is a modified version of python-docx.replace() that takes into
-        account blocks of <bs> elements at a time. The replace element can also
-        be a string or an xml etree element.
+        This is a modified version of python-docx.replace() that finds text
+        spread over any number of text blocks of a paragraph. The replace
+        element can also be a string or an xml etree element.
     
         What it does:
-        It searches the entire document body for text blocks.
-        Then scan thos text blocks for replace.
-        Since the text to search could be spawned across multiple text blocks,
-        we need to adopt some sort of algorithm to handle this situation.
-        The smaller matching group of blocks (up to bs) is then adopted.
-        If the matching group has more than one block, blocks other than first
-        are cleared and all the replacement text is put on first block.
+        The text of all the text blocks of each paragraph is joined together
+        once and the regexp is run over the joined text. Each match is then
+        mapped back to the blocks it came from: the replacement text goes in
+        the block where the match starts, the matched text is cleared from
+        the blocks after it, and text around the match stays in its block.
     
         Examples:
         original text blocks : [ 'Hel', 'lo,', ' world!' ]
@@ -850,8 +2413,8 @@ class Docx(object):
         output blocks : [ 'Hi!', '', ' world!' ]
     
         original text blocks : [ 'Hel', 'lo,', ' world!' ]
-        search / replace: 'Hello, world' / 'Hi!'
-        output blocks : [ 'Hi!!', '', '' ]
+        search / replace: 'Hello, world' / 'Hi'
+        output blocks : [ 'Hi', '', '!' ]
     
         original text blocks : [ 'Hel', 'lo,', ' world!' ]
         search / replace: 'Hel' / 'Hal'
@@ -861,147 +2424,108 @@ class Docx(object):
         @param str       search: The text to search for (regexp)
         @param mixed     replace: The replacement text or lxml.etree element to
                              append, or a list of etree elements
-        @param int       bs: See above
+        @param int       bs: Unused, matches may span any number of blocks.
+                             Kept for compatibility.
     
         @return instance The document with replacement applied
     
         """
-        # Enables debug output
-        DEBUG = False
-    
         # Compile the search regexp
         searchre = re.compile(search)
     
-        # Will match against searchels. Searchels is a list that contains last
-        # n text elements found in the document. 1 < n < bs
-        searchels = []
-    
-        for element in self._document.iter():
-            if element.tag == '{%s}t' % self.nsprefixes['w']:  # t (text) elements
-                if element.text:
-                    # Add this element to searchels
-                    searchels.append(element)
-                    if len(searchels) > bs:
-                        # Is searchels is too long, remove first elements
-                        searchels.pop(0)
-    
-                    # Search all combinations, of searchels, starting from
-                    # smaller up to bigger ones
-                    # l = search lenght
-                    # s = search start
-                    # e = element IDs to merge
-                    found = False
-                    for l in range(1, len(searchels) + 1):
-                        if found:
-                            break
-                        # print "slen:", l
-                        for s in range(len(searchels)):
-                            if found:
-                                break
-                            if s + l <= len(searchels):
-                                e = range(s, s + l)
-                                # print "elems:", e
-                                txtsearch = ''
-                                for k in e:
-                                    txtsearch += searchels[k].text
-    
-                                # Searcs for the text in the whole txtsearch
-                                match = searchre.search(txtsearch)
-                                if match:
-                                    found = True
-    
-                                    # I've found something :)
-                                    if DEBUG:
-                                        log.debug("Found element!")
-                                        log.debug("Search regexp: %s",
-                                                  searchre.pattern)
-                                        log.debug("Requested replacement: %s",
-                                                  replace)
-                                        log.debug("Matched text: %s", txtsearch)
-                                        log.debug("Matched text (splitted): %s",
-                                                  map(lambda i: i.text, searchels))
-                                        log.debug("Matched at position: %s",
-                                                  match.start())
-                                        log.debug("matched in elements: %s", e)
-                                        if isinstance(replace, etree._Element):
-                                            log.debug("Will replace with XML CODE")
-                                        elif isinstance(replace(list, tuple)):
-                                            log.debug("Will replace with LIST OF"
-                                                      " ELEMENTS")
-                                        else:
-                                            log.debug("Will replace with:",
-                                                      re.sub(search, replace,
-                                                             txtsearch))
-    
-                                    curlen = 0
-                                    replaced = False
-                                    for i in e:
-                                        curlen += len(searchels[i].text)
-                                        if curlen > match.start() and not replaced:
-                                            # The match occurred in THIS element.
-                                            # Puth in the whole replaced text
-                                            if isinstance(replace, etree._Element):
-                                                # Convert to a list and process
-                                                # it later
-                                                replace = [replace]
-                                            if isinstance(replace, (list, tuple)):
-                                                # I'm replacing with a list of
-                                                # etree elements
-                                                # clear the text in the tag and
-                                                # append the element after the
-                                                # parent paragraph
-                                                # (because t elements cannot have
-                                                # childs)
-                                                p = self._findTypeParent(
-                                                    searchels[i],
-                                                    '{%s}p' % self.nsprefixes['w'])
-                                                searchels[i].text = re.sub(
-                                                    search, '', txtsearch)
-                                                insindex = p.getparent().index(p) + 1
-                                                for r in replace:
-                                                    p.getparent().insert(
-                                                        insindex, r)
-                                                    insindex += 1
-                                            else:
-                                                # Replacing with pure text
-                                                searchels[i].text = re.sub(
-                                                    search, replace, txtsearch)
-                                            replaced = True
-                                            log.debug(
-                                                "Replacing in element #: %s", i)
-                                        else:
-                                            # Clears the other text elements
-                                            searchels[i].text = ''
+        if isinstance(replace, etree._Element):
+            # Convert to a list and process it later
+            replace = [replace]
+        elements = isinstance(replace, (list, tuple))
+    
+        # Group before changing anything, text inserted below isn't searched
+        groups = self._paragraphtexts()
+    
+        # Text is changed and elements may be inserted below
+        self._textindex = None
+    
+        for paragraph, nodes, starts in groups:
+            texts = [node.text or '' for node in nodes]
+            text = ''.join(texts)
+            matches = [match for match in searchre.finditer(text)
+                       if match.end() > match.start()]
+            if not matches:
+                continue
+            log.debug("Replacing %s matches of %s in: %s", len(matches),
+                      searchre.pattern, text)
+    
+            # Work backwards so the offsets of earlier matches stay valid
+            for match in reversed(matches):
+                first = self._locate(starts, match.start())
+                last = self._locate(starts, match.end() - 1)
+                if elements:
+                    # t elements cannot have children, the elements are
+                    # appended after the parent paragraph instead
+                    replacement = ''
+                else:
+                    replacement = match.expand(replace)
+                head = texts[first][:match.start() - starts[first]]
+                tail = texts[last][match.end() - starts[last]:]
+                if first == last:
+                    texts[first] = head + replacement + tail
+                else:
+                    texts[first] = head + replacement
+                    for i in range(first + 1, last):
+                        texts[i] = ''
+                    texts[last] = tail
+    
+            for node, newtext in zip(nodes, texts):
+                if (node.text or '') != newtext:
+                    node.text = newtext
+                    if not newtext:
+                        self._dirty.append(node)
+    
+            if elements and paragraph is not None:
+                insindex = paragraph.getparent().index(paragraph) + 1
+                for r in replace:
+                    paragraph.getparent().insert(insindex, r)
+                    insindex += 1
     
     
+    @_instrumented('extract')
     def getdocumenttext(self):
         '''Return the raw text of a document, as a list of paragraphs.'''
         paratextlist = []
-        # Compile a list of all paragraph (p) elements
-        paralist = []
-        for element in self._document.iter():
-            # Find p (paragraph) elements
-            if element.tag == '{' + self.nsprefixes['w'] + '}p':
-                paralist.append(element)
         # Since a single sentence might be spread over multiple text elements,
-        # iterate through each paragraph, appending all text (t) children to that
-        # paragraphs text.
-        for para in paralist:
-            paratext = u''
-            # Loop through each paragraph
-            for element in para.iter():
-                # Find t (text) elements
-                if element.tag == '{' + self.nsprefixes['w'] + '}t':
-                    if element.text:
-                        paratext = paratext + element.text
-                elif element.tag == '{' + self.nsprefixes['w'] + '}tab':
-                    paratext = paratext + '\t'
+        # join all text (t) children of each paragraph (p) element.
+        for para in self._document.iter(self.qn['w:p']):
+            paratext = _paragraphtext(para)
             # Add our completed paragraph text to the list of paragraph text
             if not len(paratext) == 0:
                 paratextlist.append(paratext)
         return paratextlist
     
     
+    @_instrumented('extract')
+    def gettables(self, columnar=False, heading=False):
+        """
+        Return the text of the cells of every table in the document.
+        
+        Tables nested in a cell are part of the text of that cell rather than
+        separate tables. Every w:tc is a cell, cells spanning several columns
+        aren't repeated. The text of the paragraphs of a cell is joined with
+        newlines.
+        
+        @param bool columnar: Return each table as a list of columns instead
+                              of a list of rows. Short rows are padded with
+                              None.
+        @param bool heading:  With columnar, the first row holds headings:
+                              each table is a dict of heading to column,
+                              ready for pandas.DataFrame().
+        
+        @return list          A list of rows of cell text, a list of
+                              columns or a dict of columns per table.
+        """
+        tables = self._document.xpath('//w:tbl[not(ancestor::w:tbl)]',
+                                      namespaces=self.nsprefixes)
+        return [_tabledata(table, columnar, heading) for table in tables]
+    
+    
     def coreproperties(self, title, subject, creator, keywords, lastmodifiedby=None):
         """
         Create core properties (common document properties referred to in the
@@ -1055,55 +2579,757 @@ class Docx(object):
         relationships = etree.fromstring(
             '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006'
             '/relationships"></Relationships>')
-        count = 0
-        for id_, relationship in self._relationshiplist.items():
-            # Relationship IDs (rId) start at 1.
-            rel_elm = self._makeelement('Relationship', nsprefix=None,
-                                  attributes={'Id':     'rId%s' % id_,
-                                              'Type':   relationship[0],
-                                              'Target': relationship[1]}
-                                  )
-            relationships.append(rel_elm)
-            count += 1
+        SubElement = etree.SubElement
+        for id_, (reltype, target, targetmode) in self._relationships.items():
+            rel_elm = SubElement(relationships, 'Relationship',
+                                 {'Id': id_, 'Type': reltype, 'Target': target})
+            if targetmode:
+                rel_elm.set('TargetMode', targetmode)
         return relationships
     
     
-    def savedocx(self, output):
-        '''Save a modified document'''
-      
-        self._clean()
+    def _bodyshell(self, prettyprint=False):
+        '''Return the serialized document.xml up to and after the body content
         
-        docxfile = zipfile.ZipFile(
-            output, mode='w', compression=zipfile.ZIP_DEFLATED)
-        
-        templateFile = zipfile.ZipFile(self._template)
-    
-        # Serialize our trees into out zip file
-        treesandfiles = {'word/document.xml' : self._document,
-                         'docProps/core.xml' : self._coreprops,
-                         'docProps/app.xml' : self._appprops,
-                         '[Content_Types].xml' : self._contentTypes,
-                         'word/webSettings.xml' : self._webSettings ,
-                         'word/_rels/document.xml.rels' : self._genRelationshipsTree()}
+        The template's prologue and epilogue are written around the body
+        elements by the streaming writers.
+        '''
+        marker = 'docx-body-content'
+        shell = etree.Element(self._document.tag, self._document.attrib,
+                              nsmap=self._document.nsmap)
+        for child in self._document:
+            if child is self._docbody:
+                body = etree.SubElement(shell, child.tag, child.attrib)
+                body.append(etree.Comment(marker))
+            else:
+                shell.append(copy.deepcopy(child))
+        xml = etree.tostring(shell, encoding='UTF-8', xml_declaration=True,
+                             standalone=True, pretty_print=prettyprint)
+        prologue, epilogue = xml.split(('<!--%s-->' % marker).encode('ascii'))
+        return prologue, epilogue
+    
+    
+    def _namespacedecls(self):
+        '''Return the serialized namespace declarations in scope on the body'''
+        decls = []
+        for prefix, uri in self._docbody.nsmap.items():
+            if prefix is None:
+                decl = ' xmlns="%s"' % uri
+            else:
+                decl = ' xmlns:%s="%s"' % (prefix, uri)
+            decls.append(decl.encode('utf-8'))
+        return decls
+    
+    
+    def _serializefragment(self, element, decls, prettyprint=False):
+        '''Serialize a body element without repeating the namespace
+        declarations in decls, which are already made on the document root'''
+        xml = etree.tostring(element, encoding='UTF-8', xml_declaration=False,
+                             pretty_print=prettyprint)
+        end = xml.index(b'>')
+        starttag = xml[:end]
+        for decl in decls:
+            starttag = starttag.replace(decl, b'', 1)
+        return starttag + xml[end:]
+    
+    
+    def _writedocument(self, stream, prettyprint=False):
+        '''Serialize document.xml into stream one body element at a time'''
+        prologue, epilogue = self._bodyshell(prettyprint)
+        decls = self._namespacedecls()
+        stream.write(prologue)
+        for element in self._docbody:
+            stream.write(self._serializefragment(element, decls, prettyprint))
+        stream.write(epilogue)
+    
+    
+    def _packagetrees(self):
+        '''Return the xml parts we generate, keyed by their path in the zip'''
+        return {'word/document.xml' : self._document,
+                'docProps/core.xml' : self._coreprops,
+                'docProps/app.xml' : self._appprops,
+                '[Content_Types].xml' : self._contentTypes,
+                'word/webSettings.xml' : self._webSettings ,
+                'word/_rels/document.xml.rels' : self._genRelationshipsTree()}
+    
+    
+    def _writepackage(self, docxfile, treesandfiles, prettyprint=False,
+                      policy=None, parts=()):
+        '''Write every part except word/document.xml into docxfile
         
+        @param list parts: (path, data) of parts already serialized, which
+                           are compressed along with the others
+        '''
+        policy = self._compressionpolicy(policy)
+        parts = list(parts)
         for path, tree in treesandfiles.items():
+            if tree is self._document:
+                continue
             log.info('Saving: %s' % path)
-            treestring = etree.tostring(tree, pretty_print=True)
-            docxfile.writestr(path, treestring)
+            treestring = etree.tostring(tree, pretty_print=prettyprint)
+            parts.append((path, treestring))
     
-        # Add & compress support files
+        # Copy the untouched support files over as they are
         files_to_ignore = ['.DS_Store']  # nuisance from some os's
-        for filename in templateFile.namelist():
+        for filename in self._templatedata.parts:
             if (os.path.basename(filename) in files_to_ignore
-                or filename in treesandfiles):
+                or filename in treesandfiles
+                or filename.startswith(self._templatedata.mediaPrefix)):
                 continue
             log.info('Saving: %s', filename)
-            docxfile.writestr(filename, templateFile.read(filename))
+            self._templatedata.write(docxfile, filename, policy)
             
         # Write in the media files
-        for name, data in self._media.items():
-            docxfile.writestr('word/media/%s' % name, data)
+        for name in self._media:
+            path = 'word/media/%s' % name
+            if self._media.istemplate(name):
+                self._templatedata.write(docxfile, path, policy)
+            else:
+                parts.append((path, self._media[name]))
+        
+        policy.write(docxfile, parts)
+    
+    
+    def _compressionpolicy(self, compression):
+        '''Return the CompressionPolicy for compression, which may also be
+        a deflate level or None for the default'''
+        if compression is None:
+            compression = self.compression
+        if isinstance(compression, CompressionPolicy):
+            return compression
+        if compression is None:
+            return CompressionPolicy(store=self.compressedmedia)
+        return CompressionPolicy(compression, store=self.compressedmedia)
+    
+    
+    def savedocx(self, output, prettyprint=False, streaming=False,
+                 compression=None):
+        '''Save a modified document
+        
+        @param bool prettyprint: Indent the xml parts. This makes the output
+                                 larger and slower to write.
+        @param bool streaming:   Serialize word/document.xml straight into the
+                                 zip member one body element at a time instead
+                                 of building the whole string in memory.
+        @param mixed compression: A CompressionPolicy, or the deflate level
+                                  of every part, 0 to store them. Defaults
+                                  to Docx.compression.
+        
+        output is a path or a writable file object. File objects that can't
+        seek, such as sockets, are written to front to back.
+        
+        Text emptied by the replace methods is cleaned up first, see clean().
+        '''
+        if self._stream:
+            raise Exception('document is being streamed, use endstream()')
+      
+        self.clean()
+        self._writedocx(output, prettyprint, streaming, compression)
+    
+    
+    def tobytes(self, prettyprint=False, compression=None):
+        '''Return the saved document as a string of bytes, see savedocx()'''
+        output = io.BytesIO()
+        self.savedocx(output, prettyprint, compression=compression)
+        return output.getvalue()
+    
+    
+    @_instrumented('save')
+    def _writedocx(self, output, prettyprint=False, streaming=False,
+                   compression=None):
+        '''Write the package to output as it is, see savedocx()'''
+        output = _fspath(output)
+        policy = self._compressionpolicy(compression)
+        docxfile, temp = self._openoutput(output)
+        try:
+            # Serialize our trees into out zip file
+            treesandfiles = self._packagetrees()
+        
+            log.info('Saving: word/document.xml')
+            parts = []
+            with self._phase('serialize'):
+                if streaming:
+                    path = 'word/document.xml'
+                    stream = _ZipMemberWriter(docxfile, path,
+                                              policy.levelfor(path))
+                    self._writedocument(stream, prettyprint)
+                    stream.close()
+                    self._stat('bytes', docxfile.getinfo(path).file_size)
+                else:
+                    treestring = etree.tostring(self._document,
+                                                pretty_print=prettyprint)
+                    # Compressed with the other parts
+                    parts.append(('word/document.xml', treestring))
+                    self._stat('bytes', len(treestring))
+        
+            with self._phase('package'):
+                self._writepackage(docxfile, treesandfiles, prettyprint,
+                                   policy, parts)
+        except Exception:
+            self._closeoutput(docxfile, output, temp, False)
+            raise
           
         log.info('Saved new file to: %r', output)
-        docxfile.close()
+        self._statparts(docxfile)
+        self._closeoutput(docxfile, output, temp)
+    
+    
+    def _openoutput(self, output):
+        '''Return a ZipFile writing to output, and the temporary file it
+        writes to instead when output is the template, or None
+        
+        Other documents may still be reading the template, so it is only
+        replaced by _closeoutput() once the new package is complete.
+        '''
+        temp = None
+        if (isinstance(output, basestring) and not _iszipdata(self._template)
+            and os.path.abspath(output) == os.path.abspath(self._template)):
+            # This document no longer needs the template once it is saved
+            self._media.load()
+            fd, temp = tempfile.mkstemp(
+                suffix='.docx', dir=os.path.dirname(os.path.abspath(output)))
+            os.close(fd)
+            shutil.copymode(output, temp)
+        try:
+            docxfile = zipfile.ZipFile(_outputstream(temp or output), mode='w',
+                                       compression=zipfile.ZIP_DEFLATED)
+        except Exception:
+            if temp is not None:
+                os.remove(temp)
+            raise
+        return docxfile, temp
+    
+    
+    def _closeoutput(self, docxfile, output, temp, complete=True):
+        '''Close a ZipFile from _openoutput(), moving a complete package
+        over the template or dropping an incomplete one'''
+        try:
+            docxfile.close()
+        except Exception:
+            if complete:
+                raise
+        if temp is None:
+            return
+        if complete:
+            _replacefile(temp, output)
+        else:
+            os.remove(temp)
+    
+    
+    def _statparts(self, docxfile):
+        '''Record the compressed size of each part written, if instrumented'''
+        if not self._phases:
+            return
+        infos = docxfile.infolist()
+        self._stat('parts', dict((info.filename, info.compress_size)
+                                 for info in infos))
+        self._stat('bytes', sum(info.compress_size for info in infos))
+        self._stat('uncompressed', sum(info.file_size for info in infos))
+    
+    
+    def startstream(self, output, prettyprint=False, compression=None):
+        '''Start writing the document body straight to output
+        
+        From now on every element added by paragraph(), heading(), table(),
+        picture() and pagebreak() is written to output, and dropped from
+        memory, as soon as the next element is added. So elements returned by
+        those methods can still be changed until the next call. search() and
+        replace() only see elements that haven't been written yet.
+        
+        The template's final sectPr is held back and written by endstream(),
+        which also writes the rest of the package. compression is as for
+        savedocx().
+        '''
+        if self._stream:
+            raise Exception('document is already being streamed')
+        
+        output = _fspath(output)
+        docxfile, temp = self._openoutput(output)
+        
+        # The section properties of the last section have to stay at the
+        # very end of the body
+        sectPr = None
+        if (len(self._docbody)
+            and self._docbody[-1].tag == '{%s}sectPr' % self.nsprefixes['w']):
+            sectPr = self._docbody[-1]
+            self._docbody.remove(sectPr)
+        
+        log.info('Streaming: word/document.xml')
+        prologue, epilogue = self._bodyshell(prettyprint)
+        policy = self._compressionpolicy(compression)
+        writer = _ZipMemberWriter(docxfile, 'word/document.xml',
+                                  policy.levelfor('word/document.xml'))
+        writer.write(prologue)
+        self._stream = {'output': output,
+                        'docxfile': docxfile,
+                        'temp': temp,
+                        'writer': writer,
+                        'policy': policy,
+                        'decls': self._namespacedecls(),
+                        'prettyprint': prettyprint,
+                        'sectPr': sectPr,
+                        'epilogue': epilogue}
+        self._flushstream()
+    
+    
+    def _flushstream(self):
+        '''Write out and drop every element in the body'''
+        stream = self._stream
+        self.clean()
+        for element in list(self._docbody):
+            stream['writer'].write(self._serializefragment(
+                element, stream['decls'], stream['prettyprint']))
+            self._docbody.remove(element)
+        self._textindex = None
+    
+    
+    def _appendbody(self, element):
+        '''Append element to the body, flushing earlier ones when streaming'''
+        if self._stream:
+            self._flushstream()
+        self._docbody.append(element)
+        if self._textindex is not None:
+            self._textindex.add(element)
+    
+    
+    @_instrumented('save')
+    def endstream(self):
+        '''Finish a document started with startstream() and close the output'''
+        stream = self._stream
+        if not stream:
+            raise Exception('document is not being streamed')
+        
+        self._flushstream()
+        if stream['sectPr'] is not None:
+            self._docbody.append(stream['sectPr'])
+            self._flushstream()
+        stream['writer'].write(stream['epilogue'])
+        stream['writer'].close()
+        self._stream = None
+        
+        docxfile = stream['docxfile']
+        with self._phase('package'):
+            self._writepackage(docxfile, self._packagetrees(),
+                               stream['prettyprint'], stream['policy'])
+        log.info('Saved new file to: %r', stream['output'])
+        self._statparts(docxfile)
+        self._closeoutput(docxfile, stream['output'], stream['temp'])
+
+
+class MailMerge(object):
+    ''' Fill one template with many records
+    
+    The template is loaded and searched for placeholders once. Each
+    placeholder, even one Word has split over several runs, becomes a slot
+    in the text element where it starts. Rendering a record only sets the
+    text of those elements and writes the document out.
+    
+    Only placeholders in the document body are filled.
+    
+    Example:
+        merge = MailMerge('letter.docx')
+        for data in merge.iterrender(customers):
+            send(data)
+    '''
+    
+    def __init__(self, template=None, pattern=r'__(\w+)__'):
+        '''
+        @param str template: Path of the template, or a Docx to fill in
+        @param str pattern:  Regexp matching a placeholder. The field name is
+                             the first group, or the whole match if there
+                             are no groups.
+        '''
+        if isinstance(template, Docx):
+            self.docx = template
+        else:
+            self.docx = Docx(template)
+        self.pattern = re.compile(pattern)
+        # (text element, [literal text or _MergeField, ...])
+        self._slots = []
+        self.fields = set()
+        self._compile()
+    
+    def _compile(self):
+        '''Find the placeholders and turn their elements into slots'''
+        docx = self.docx
+        for paragraph, nodes, starts in docx._paragraphtexts():
+            texts = [node.text or '' for node in nodes]
+            text = ''.join(texts)
+            matches = [match for match in self.pattern.finditer(text)
+                       if match.end() > match.start()]
+            if not matches:
+                continue
+            
+            pieces = [[] for node in nodes]
+            
+            def addliteral(start, end):
+                # Literal text stays in the element it came from
+                i = docx._locate(starts, start)
+                while i < len(nodes) and starts[i] < end:
+                    literal = text[max(start, starts[i]):
+                                   min(end, starts[i] + len(texts[i]))]
+                    if literal:
+                        pieces[i].append(literal)
+                    i += 1
+            
+            cursor = 0
+            for match in matches:
+                addliteral(cursor, match.start())
+                name = match.group(1) if self.pattern.groups else match.group()
+                self.fields.add(name)
+                first = docx._locate(starts, match.start())
+                pieces[first].append(_MergeField(name, match.group()))
+                cursor = match.end()
+            addliteral(cursor, len(text))
+            
+            for node, nodepieces in zip(nodes, pieces):
+                node.text = ''.join([unicode(piece) for piece in nodepieces])
+                if not nodepieces:
+                    docx._dirty.append(node)
+                if [p for p in nodepieces if isinstance(p, _MergeField)]:
+                    node.set('{http://www.w3.org/XML/1998/namespace}space',
+                             'preserve')
+                    self._slots.append((node, nodepieces))
+        
+        # Drop the elements emptied above once, rendering never cleans as
+        # that would remove slots filled with empty values
+        docx.clean()
+        docx.reindex()
+    
+    def fill(self, record):
+        '''Set the slots to the values of record, a dict keyed by field name
+        
+        Raises KeyError for fields missing from record.
+        '''
+        for node, pieces in self._slots:
+            node.text = ''.join([
+                unicode(record[piece.name]) if isinstance(piece, _MergeField)
+                else piece for piece in pieces])
+    
+    def render(self, record, output):
+        '''Fill in record and save the document to output, a path or file'''
+        self.fill(record)
+        self.docx._writedocx(output)
+    
+    def renderbytes(self, record):
+        '''Fill in record and return the document as a string of bytes'''
+        output = io.BytesIO()
+        self.render(record, output)
+        return output.getvalue()
+    
+    def iterrender(self, records, output=None):
+        '''Render each of records in turn
+        
+        @param iterable records: dicts keyed by field name
+        @param mixed    output:  None to yield the bytes of each document,
+                                 or a format string filled in with the
+                                 record and its index (as 'index') or a
+                                 callable taking (index, record) giving the
+                                 path to save each document to, which is
+                                 yielded instead.
+        '''
+        for index, record in enumerate(records):
+            if output is None:
+                yield self.renderbytes(record)
+                continue
+            path = _outputpath(output, index, record)
+            self.render(record, path)
+            yield path
+
+
+def _outputpath(output, index, record):
+    '''Return the path to save a rendered record to, see iterrender()'''
+    if callable(output):
+        return output(index, record)
+    values = dict(record) if isinstance(record, dict) else {}
+    values['index'] = index
+    return output % values
+
+
+def _paragraphtext(paragraph):
+    '''Return the text of a paragraph element, tabs included'''
+    texttag = Docx.qn['w:t']
+    parts = []
+    for element in paragraph.iter(texttag, Docx.qn['w:tab']):
+        if element.tag == texttag:
+            if element.text:
+                parts.append(element.text)
+        else:
+            parts.append(u'\t')
+    return u''.join(parts)
+
+
+def _runkey(run):
+    '''Return what a run has to match to be merged with the next one, or
+    None when it holds more than its properties and a text element'''
+    qn = Docx.qn
+    if not len(run) or run[-1].tag != qn['w:t'] or len(run[-1]):
+        return None
+    if len(run) == 1:
+        return b''
+    if len(run) == 2 and run[0].tag == qn['w:rPr']:
+        # Empty properties are the same as none
+        return etree.tostring(run[0]) if len(run[0]) else b''
+    return None
+
+
+def _mergeruns(paragraph):
+    '''Merge adjacent runs of a paragraph with the same properties, return
+    the number of runs merged away'''
+    runtag = Docx.qn['w:r']
+    merged = 0
+    previous = previouskey = None
+    for child in list(paragraph):
+        key = _runkey(child) if child.tag == runtag else None
+        if key is None or key != previouskey:
+            previous, previouskey = child, key
+            continue
+        text = previous[-1]
+        text.text = (text.text or '') + (child[-1].text or '')
+        if text.text != text.text.strip():
+            text.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+        paragraph.remove(child)
+        merged += 1
+    return merged
+
+
+def iterdocumenttext(docx):
+    '''Yield the text of each paragraph of a docx file, like
+    Docx.getdocumenttext() but without loading the document
+    
+    Only word/document.xml is read, as it is decompressed. Each paragraph is
+    dropped once its text has been taken, so memory use doesn't grow with the
+    size of the document, or with the media in it.
+    
+    @param mixed docx: Path of the docx file, its data or a file object
+    '''
+    ptag = Docx.qn['w:p']
+    tbltag = Docx.qn['w:tbl']
+    # Paragraphs open around the current element, such as the one holding a
+    # text box with paragraphs of its own
+    depth = 0
+    package = _PackageReader(docx)
+    try:
+        source = package.open(_Template.documentPath)
+        try:
+            for event, element in etree.iterparse(source,
+                                                  events=('start', 'end'),
+                                                  tag=(ptag, tbltag)):
+                if element.tag == ptag:
+                    depth += 1 if event == 'start' else -1
+                if event == 'start' or depth:
+                    # Nested paragraphs are read along with the outer one
+                    continue
+                if element.tag == ptag:
+                    for paragraph in element.iter(ptag):
+                        paratext = _paragraphtext(paragraph)
+                        if paratext:
+                            yield paratext
+                # Drop what we're done with, including the emptied elements
+                # before this one
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        finally:
+            source.close()
+    finally:
+        package.close()
+
+
+def _tabledata(table, columnar=False, heading=False):
+    '''Return the cell text of a table element, see Docx.gettables()'''
+    qn = Docx.qn
+    trtag, tctag, ptag = qn['w:tr'], qn['w:tc'], qn['w:p']
+    rows = []
+    for row in table.iterchildren(trtag):
+        rows.append([u'\n'.join([_paragraphtext(p) for p in cell.iter(ptag)])
+                     for cell in row.iterchildren(tctag)])
+    if not columnar:
+        return rows
+    
+    width = max([len(row) for row in rows] or [0])
+    columns = [[] for i in range(width)]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+        for column in columns[len(row):]:
+            column.append(None)
+    if not heading:
+        return columns
+    
+    data = {}
+    for i, column in enumerate(columns):
+        name = column[0]
+        if not name or name in data:
+            # Headings have to be unique, use the column number instead
+            name = i
+        data[name] = column[1:]
+    return data
+
+
+def itertables(docx, columnar=False, heading=False):
+    '''Yield the cell text of each table of a docx file, like
+    Docx.gettables() but without loading the document
+    
+    Only word/document.xml is read, and each table is dropped once it has
+    been yielded, so documents with many large tables can be read in
+    constant memory.
+    
+    @param mixed docx: Path of the docx file, its data or a file object
+    '''
+    ptag = Docx.qn['w:p']
+    tbltag = Docx.qn['w:tbl']
+    depth = 0
+    package = _PackageReader(docx)
+    try:
+        source = package.open(_Template.documentPath)
+        try:
+            for event, element in etree.iterparse(source,
+                                                  events=('start', 'end'),
+                                                  tag=(ptag, tbltag)):
+                if element.tag == tbltag:
+                    depth += 1 if event == 'start' else -1
+                    if event == 'start' or depth:
+                        continue
+                    yield _tabledata(element, columnar, heading)
+                elif event == 'start' or depth:
+                    # Paragraphs in a table are kept until it has been read
+                    continue
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        finally:
+            source.close()
+    finally:
+        package.close()
+
+
+class _MergeField(object):
+    ''' A placeholder in a MailMerge slot '''
+    
+    def __init__(self, name, placeholder):
+        self.name = name
+        self.placeholder = placeholder
+    
+    def __unicode__(self):
+        return self.placeholder
+    
+    __str__ = __unicode__
+
+
+RenderResult = collections.namedtuple('RenderResult', 'index result error')
+
+
+# Set in each ParallelRenderer worker process by _initrenderworker()
+_renderworker = None
+
+
+def _initrenderworker(template, populate, output):
+    global _renderworker
+    _renderworker = (template, populate, output)
+    # Parse the template once, every Docx in this worker copies it
+    if template is None:
+        Docx()
+    else:
+        templatecache.get(template)
+
+
+def _renderone(task):
+    '''Render one input in a ParallelRenderer worker'''
+    index, item = task
+    template, populate, output = _renderworker
+    return _render(template, populate, output, index, item)
+
+
+def _render(template, populate, output, index, item):
+    '''Create a Docx from template, populate it with item and save it'''
+    try:
+        docx = Docx(template)
+        try:
+            populate(docx, item)
+            if output is None:
+                return RenderResult(index, docx.tobytes(), None)
+            path = _outputpath(output, index, item)
+            docx.savedocx(path)
+            return RenderResult(index, path, None)
+        finally:
+            docx.close()
+    except Exception:
+        # The exception itself may not survive pickling, send its traceback
+        return RenderResult(index, None, traceback.format_exc())
+
+
+class ParallelRenderer(object):
+    ''' Render many documents from one template with a pool of processes
+    
+    Every worker loads the template once when it starts and keeps it in its
+    template cache. For each input a worker creates a Docx from the
+    template, calls populate(docx, input) and saves the document.
+    
+    populate and output have to be picklable, so use module level functions.
+    
+    Example:
+        def populate(docx, customer):
+            docx.advReplace('__name__', customer['name'])
+        
+        with ParallelRenderer('letter.docx', populate) as renderer:
+            for result in renderer.render(customers):
+                if result.error:
+                    log.error('customer %s failed: %s', result.index,
+                              result.error)
+    '''
+    
+    def __init__(self, template, populate, output=None, processes=None):
+        '''
+        @param str      template:  Path of the template, None for the default
+        @param callable populate:  Called with (docx, input) to fill in a
+                                   document
+        @param mixed    output:    None to get the bytes of each document
+                                   back, or a format string or callable
+                                   giving a path to save it to, see
+                                   MailMerge.iterrender()
+        @param int      processes: Number of workers, defaults to the number
+                                   of CPUs. 0 renders in this process.
+        '''
+        self.template = template
+        self.populate = populate
+        self.output = output
+        self._pool = None
+        if processes != 0:
+            self._pool = multiprocessing.Pool(
+                processes, _initrenderworker, (template, populate, output))
+    
+    def render(self, inputs, ordered=True, chunksize=1):
+        '''Yield a RenderResult(index, result, error) for each input
         
+        result is the bytes or path of the document, error the formatted
+        traceback if populating or saving it failed, the other inputs are
+        still rendered.
+        
+        @param bool ordered:   Yield results in the order of inputs, rather
+                               than as they are completed.
+        @param int  chunksize: Inputs sent to a worker at a time.
+        '''
+        tasks = enumerate(inputs)
+        if self._pool is None:
+            render = functools.partial(_render, self.template, self.populate,
+                                       self.output)
+            return (render(index, item) for index, item in tasks)
+        if ordered:
+            return self._pool.imap(_renderone, tasks, chunksize)
+        return self._pool.imap_unordered(_renderone, tasks, chunksize)
+    
+    def close(self):
+        '''Wait for the workers to finish and stop them'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        if exc_info[0] is not None and self._pool is not None:
+            self._pool.terminate()
+        self.close()
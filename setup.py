@@ -20,7 +20,7 @@ setup(name='docx',
       maintainer='Steve Canny',
       maintainer_email='python-docx@googlegroups.com',
       url='http://github.com/mikemaccana/python-docx',
-      py_modules=['docx'],
+      py_modules=['docx', 'asyncdocx'],
       data_files=[
           ('docx-template/_rels', glob('template/_rels/.*')),
           ('docx-template/docProps', glob('template/docProps/*.*')),
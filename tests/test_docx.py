@@ -2,9 +2,13 @@
 '''
 Test docx module
 '''
+import io
 import os
+import struct
 import lxml
-from docx import Docx
+from docx import (Docx, TemplateCache, MailMerge, ParallelRenderer,
+                  CompressionPolicy, ImageOptimizer, PhaseCollector,
+                  iterdocumenttext, itertables)
 
 TEST_FILE = 'ShortTest.docx'
 IMAGE1_FILE = 'image1.png'
@@ -108,6 +112,592 @@ def testtable():
     assert testtable.xpath('/ns0:tbl/ns0:tr[2]/ns0:tc[2]/ns0:p/ns0:r/ns0:t',
                            namespaces={'ns0':'http://schemas.openxmlformats.org/wordprocessingml/2006/main'})[0].text == 'B2'
 
+def testtemplatecache():
+    '''Ensure templates are parsed once and each Docx gets its own copy'''
+    cache = TemplateCache(maxsize=1)
+    Docx.templatecache, oldcache = cache, Docx.templatecache
+    try:
+        first = Docx()
+        second = Docx()
+        assert (cache.hits, cache.misses) == (1, 1)
+        first.paragraph('only in first')
+        assert first.search('only in first')
+        assert not second.search('only in first')
+        Docx(TEST_FILE)
+        assert len(cache) == 1
+        cache.invalidate()
+        assert len(cache) == 0
+    finally:
+        Docx.templatecache = oldcache
+
+def teststreamingsave():
+    '''Ensure a streamed document.xml matches the in memory one'''
+    import zipfile
+    docx = simpledoc()
+    docx.savedocx(TEST_FILE)
+    expected = zipfile.ZipFile(TEST_FILE).read('word/document.xml')
+    docx.savedocx(TEST_FILE, streaming=True)
+    streamed = zipfile.ZipFile(TEST_FILE).read('word/document.xml')
+    assert lxml.etree.tostring(lxml.etree.fromstring(streamed), method='c14n') \
+        == lxml.etree.tostring(lxml.etree.fromstring(expected), method='c14n')
+    assert Docx(TEST_FILE, cache=False).search('Paragraph 3')
+
+def teststreamingbuilder():
+    '''Ensure streamed body elements end up in order before the sectPr'''
+    docx = Docx()
+    docx.startstream(TEST_FILE)
+    for i in range(50):
+        docx.paragraph('Streamed %s' % i)
+    docx.table([['A1', 'A2'], ['B1', 'B2']])
+    assert len(docx._docbody) == 1
+    docx.endstream()
+    docx = Docx(TEST_FILE, cache=False)
+    paratextlist = docx.getdocumenttext()
+    assert paratextlist[:2] == ['Streamed 0', 'Streamed 1']
+    assert paratextlist[-4:] == ['A1', 'A2', 'B1', 'B2']
+    assert docx._docbody[-1].tag == \
+        '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}sectPr'
+
+def testcompression():
+    '''Ensure the compression policy decides how parts are written'''
+    import zipfile
+    docx = Docx()
+    for i in range(50):
+        docx.paragraph('Compress me %d' % i)
+    docx.picture(IMAGE1_FILE, 'Stored as it is')
+    docx.savedocx(TEST_FILE, compression=0)
+    stored = zipfile.ZipFile(TEST_FILE)
+    assert stored.testzip() is None
+    info = stored.getinfo('word/document.xml')
+    assert info.compress_type == zipfile.ZIP_STORED
+    document = stored.read('word/document.xml')
+    stored.close()
+    policy = CompressionPolicy(1, levels={'word/document.xml': 9}, threads=2)
+    for streaming in (False, True):
+        docx.savedocx(TEST_FILE, streaming=streaming, compression=policy)
+        deflated = zipfile.ZipFile(TEST_FILE)
+        assert deflated.testzip() is None
+        info = deflated.getinfo('word/document.xml')
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < len(document)
+        if not streaming:
+            assert deflated.read('word/document.xml') == document
+        info = deflated.getinfo('word/media/image1.png')
+        assert info.compress_type == zipfile.ZIP_STORED
+        deflated.close()
+    if hasattr(zipfile, 'ZIP_BZIP2'):
+        # Parts we can't copy as they are follow the policy too
+        output = io.BytesIO()
+        with zipfile.ZipFile(io.BytesIO(docx.tobytes())) as source:
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_BZIP2) as target:
+                for name in source.namelist():
+                    target.writestr(name, source.read(name))
+        Docx(output.getvalue()).savedocx(TEST_FILE, compression=0)
+        with zipfile.ZipFile(TEST_FILE) as saved:
+            info = saved.getinfo('word/styles.xml')
+            assert info.compress_type == zipfile.ZIP_STORED
+
+def testsavetargets():
+    '''Ensure documents go to and come from memory and streams'''
+    import zipfile
+    
+    class Socket(object):
+        '''Output that can only be written to'''
+        def __init__(self):
+            self.chunks = []
+        def write(self, data):
+            self.chunks.append(data)
+    
+    docx = Docx()
+    docx.paragraph('In memory')
+    docx.picture(IMAGE1_FILE, 'Image')
+    data = docx.tobytes()
+    socket = Socket()
+    docx.savedocx(socket)
+    streamed = b''.join(socket.chunks)
+    assert zipfile.ZipFile(io.BytesIO(streamed)).testzip() is None
+    for template in (data, io.BytesIO(streamed), bytearray(data)):
+        copy = Docx(template)
+        assert 'In memory' in copy.getdocumenttext()
+        assert 'image1.png' in copy._media
+        output = io.BytesIO()
+        copy.savedocx(output)
+        saved = zipfile.ZipFile(io.BytesIO(output.getvalue()))
+        assert saved.testzip() is None
+        assert saved.read('word/media/image1.png') == \
+            zipfile.ZipFile(io.BytesIO(data)).read('word/media/image1.png')
+    
+    class Path(object):
+        '''A path object, like pathlib.Path'''
+        def __fspath__(self):
+            return TEST_FILE
+    
+    docx.savedocx(Path())
+    assert 'In memory' in Docx(Path(), cache=False).getdocumenttext()
+
+def testpackagereader():
+    '''Ensure templates are read through one package that gets closed'''
+    import zipfile
+    docx = Docx()
+    docx.paragraph('Packaged')
+    docx.picture(IMAGE1_FILE, 'Image')
+    docx.savedocx(TEST_FILE)
+    with open(TEST_FILE, 'rb') as f:
+        data = f.read()
+    for template in (TEST_FILE, data, memoryview(data)):
+        for usemmap in (False, True):
+            with Docx(template, cache=False, usemmap=usemmap) as copy:
+                package = copy._templatedata.package
+                assert package._zipfile is not None
+                assert copy._media['image1.png']
+            assert package._zipfile is None
+            # Closed templates are opened again when needed
+            output = io.BytesIO()
+            copy.savedocx(output)
+            saved = zipfile.ZipFile(io.BytesIO(output.getvalue()))
+            assert saved.read('word/media/image1.png') == \
+                zipfile.ZipFile(TEST_FILE).read('word/media/image1.png')
+            copy.close()
+    assert 'Packaged' in list(iterdocumenttext(data))
+    cached = Docx(TEST_FILE)
+    cached.close()
+    assert cached._templatedata.package._zipfile is not None
+    Docx.templatecache.invalidate(TEST_FILE)
+    assert cached._templatedata.package._zipfile is None
+
+def testrawcopy():
+    '''Ensure untouched template parts are copied over unchanged'''
+    import zipfile
+    docx = simpledoc()
+    docx.savedocx(TEST_FILE)
+    template = zipfile.ZipFile(docx._template)
+    output = zipfile.ZipFile(TEST_FILE)
+    assert output.testzip() is None
+    for name in ('word/styles.xml', 'docProps/thumbnail.jpeg'):
+        assert output.getinfo(name).CRC == template.getinfo(name).CRC
+        assert output.read(name) == template.read(name)
+    assert output.getinfo('word/media/image1.png').compress_type == \
+        zipfile.ZIP_STORED
+
+def testreplacemany():
+    '''Ensure several placeholders are replaced in one pass'''
+    docx = simpledoc()
+    assert docx.search('Paragraph 2')
+    count = docx.replacemany({'Paragraph': 'Para', 'Paragraph 2': 'Second',
+                              'B2': 'b.2'})
+    assert count == 4
+    assert docx.search('Second')
+    assert docx.search('Para 3')
+    assert not docx.search('Paragraph')
+    assert docx.search(r'b\.2')
+    docx.paragraph('Paragraph 4')
+    assert docx.search('Paragraph 4')
+    try:
+        docx.replacemany({'': 'X', 'B3': 'b3'})
+    except ValueError:
+        assert docx.search('B3')
+    else:
+        assert False
+
+def testreplaceadopted():
+    '''Ensure a paragraph put in a table cell is only replaced in once'''
+    docx = Docx()
+    docx.search('x')
+    paragraph = docx.paragraph('cell')
+    docx.table([['h'], [paragraph]])
+    docx.replace('cell', 'cell!')
+    assert docx.getdocumenttext()[-1] == 'cell!'
+    assert docx.replacemany({'cell!': 'done'}) == 1
+
+def testadvreplace():
+    '''Ensure matches spanning any number of runs are found and replaced'''
+    docx = Docx()
+    docx.paragraph([('Dear ', ''), ('__na', 'b'), ('m', ''), ('e', 'i'),
+                    ('__, hello', '')])
+    docx.paragraph([('Hel', ''), ('lo,', ''), (' world!', '')])
+    assert docx.AdvSearch('__[a-z]+__') == set(['__name__'])
+    assert not docx.AdvSearch('hello Hel')
+    docx.advReplace('__([a-z]+)__', r'<\1>')
+    docx.advReplace('Hello, world', 'Hi')
+    paratextlist = docx.getdocumenttext()
+    assert paratextlist[-2:] == ['Dear <name>, hello', 'Hi!']
+    runs = docx._docbody[-1].xpath('w:r/w:t', namespaces=docx.nsprefixes)
+    assert [run.text for run in runs] == ['Hi', '', '!']
+
+def testincrementalclean():
+    '''Ensure cleaning visits the emptied elements and merges runs'''
+    docx = Docx()
+    docx.paragraph([('Dear ', ''), ('__na', ''), ('me__', ''), (',', '')])
+    docx.paragraph([('Keep ', ''), ('', '')])
+    runs = [len(p) for p in docx._docbody[-2:]]
+    docx.advReplace('__name__', 'Ann')
+    assert len(docx._dirty) == 1
+    docx.clean(mergeruns=True)
+    assert not docx._dirty
+    first, second = docx._docbody[-2:]
+    assert len(second) == runs[1]
+    texts = first.xpath('w:r/w:t', namespaces=docx.nsprefixes)
+    assert [t.text for t in texts] == ['Dear Ann,']
+    docx.clean(full=True)
+    assert len(second) == runs[1] - 1
+
+def testnormalize():
+    '''Ensure runs split by Word are merged back together'''
+    docx = Docx()
+    docx.paragraph([('Hello ', 'b'), ('wor', ''), ('ld', ''), ('!', '')])
+    paragraph = docx._docbody[-1]
+    w = docx.qn
+    runs = paragraph.findall(w['w:r'])
+    runs[1].set(w['w:rsidR'], '00A1B2C3')
+    runs[2].set(w['w:rsidRPr'], '00D4E5F6')
+    runs[2].insert(1, lxml.etree.Element(w['w:lastRenderedPageBreak']))
+    runs[2].addprevious(lxml.etree.Element(w['w:proofErr'],
+                                           {w['w:type']: 'spellStart'}))
+    assert not docx.search('world')
+    assert docx.normalize() == 2
+    texts = paragraph.xpath('w:r/w:t', namespaces=docx.nsprefixes)
+    assert [t.text for t in texts] == ['Hello ', 'world!']
+    assert not paragraph.xpath('.//w:proofErr', namespaces=docx.nsprefixes)
+    assert docx.search('world')
+
+def testinstrument():
+    '''Ensure instrumented documents report their phases'''
+    collector = PhaseCollector()
+    events = []
+    
+    def instrument(docx, event, phase, stats):
+        events.append((event, phase))
+        collector(docx, event, phase, stats)
+    
+    for i in range(2):
+        docx = Docx(instrument=instrument)
+        docx.paragraph('Hello __name__')
+        assert docx.replacemany({'__name__': 'world'}) == 1
+        docx.savedocx(TEST_FILE)
+    assert events[:2] == [('start', 'load'), ('start', 'template')]
+    report = collector.report()
+    phases = report['phases']
+    assert phases['load']['count'] == 2
+    assert phases['loaddocx']['elements'] > 0
+    assert phases['replace']['replacements'] == 2
+    assert phases['serialize']['bytes'] > 0
+    assert phases['save']['bytes'] == sum(report['parts'].values())
+    assert report['parts']['word/document.xml'] > 0
+    assert phases['save']['min'] <= phases['save']['mean']
+    assert Docx.instrument is None
+    assert Docx()._phases == []
+    # A plain function set on the class isn't called as a method
+    del events[:]
+    Docx.instrument = instrument
+    try:
+        Docx().paragraph('Class wide')
+    finally:
+        Docx.instrument = None
+    assert ('end', 'paragraph') in events
+
+def testmailmerge():
+    '''Ensure placeholders split over runs are filled for each record'''
+    docx = Docx()
+    docx.paragraph([('Dear __first', ''), ('_na', 'b'), ('me__ __last', ''),
+                    ('__,', 'i')])
+    docx.paragraph('Total: __total__')
+    docx.savedocx(TEST_FILE)
+    merge = MailMerge(TEST_FILE)
+    assert merge.fields == set(['first_name', 'last', 'total'])
+    records = [{'first_name': 'Ann', 'last': 'Lee', 'total': 3},
+               {'first_name': '', 'last': 'Smith', 'total': 12}]
+    outputs = list(merge.iterrender(records))
+    assert len(outputs) == 2
+    for data, expected in zip(outputs, [['Dear Ann Lee,', 'Total: 3'],
+                                        ['Dear  Smith,', 'Total: 12']]):
+        with open(TEST_FILE, 'wb') as output:
+            output.write(data)
+        assert Docx(TEST_FILE, cache=False).getdocumenttext()[-2:] == expected
+
+def populatedoc(docx, text):
+    '''Fill in a document for testparallelrender'''
+    if text is None:
+        raise ValueError('no text')
+    docx.paragraph(text)
+
+def testparallelrender():
+    '''Ensure documents are rendered in worker processes, errors captured'''
+    inputs = ['first', None, 'third']
+    for processes in (0, 2):
+        with ParallelRenderer(None, populatedoc,
+                              processes=processes) as renderer:
+            results = list(renderer.render(inputs))
+        assert [result.index for result in results] == [0, 1, 2]
+        assert results[1].result is None
+        assert 'no text' in results[1].error
+        with open(TEST_FILE, 'wb') as output:
+            output.write(results[2].result)
+        assert Docx(TEST_FILE, cache=False).getdocumenttext()[-1] == 'third'
+    # In process renderers used side by side keep their own populate
+    first = ParallelRenderer(None, populatedoc, processes=0).render(['A'])
+    second = ParallelRenderer(None, lambda docx, text: None,
+                              processes=0).render(['B'])
+    result = next(first)
+    next(second)
+    assert Docx(result.result).getdocumenttext()[-1] == 'A'
+
+def testasync():
+    '''Ensure documents are opened, saved and rendered on an event loop'''
+    import sys
+    if sys.version_info < (3, 7):
+        from nose.plugins.skip import SkipTest
+        raise SkipTest('asyncdocx needs Python 3.7')
+    import asyncio
+    from asyncdocx import AsyncDocx, AsyncRenderer
+    loop = asyncio.new_event_loop()
+    try:
+        doc = loop.run_until_complete(AsyncDocx.open())
+        loop.run_until_complete(doc.paragraph('async'))
+        # A cancelled call that has started still holds the document
+        import time
+        running = []
+        overlaps = []
+        def slow():
+            overlaps.append(len(running))
+            running.append(True)
+            time.sleep(0.1)
+            running.pop()
+        doc.docx.slow = slow
+        first = loop.create_task(doc.call('slow'))
+        loop.run_until_complete(asyncio.sleep(0.03))
+        first.cancel()
+        second = loop.create_task(doc.call('slow'))
+        loop.run_until_complete(asyncio.wait([first, second]))
+        assert first.cancelled()
+        assert overlaps == [0, 0]
+        data = loop.run_until_complete(doc.save_async())
+        loop.run_until_complete(doc.close())
+        assert Docx(data).getdocumenttext()[-1] == 'async'
+        renderer = AsyncRenderer(None, populatedoc, concurrency=2)
+        for ordered in (True, False):
+            results = loop.run_until_complete(
+                renderer.renderall(['first', None, 'third'], ordered))
+            assert sorted(result.index for result in results) == [0, 1, 2]
+            errors = [result for result in results if result.error]
+            assert [result.index for result in errors] == [1]
+            assert 'no text' in errors[0].error
+        # A template given as data is parsed once for every record
+        renderer = AsyncRenderer(data, populatedoc)
+        results = loop.run_until_complete(renderer.renderall(['x', 'y']))
+        parsed = renderer._parsed
+        loop.run_until_complete(renderer.renderall(['z']))
+        assert renderer._parsed is parsed
+        assert Docx(results[1].result).getdocumenttext()[-2:] == \
+            ['async', 'y']
+        # Closing the iteration early leaves no render behind
+        results = renderer.render(['first'] * 10)
+        first = loop.run_until_complete(results.__anext__())
+        assert first.index == 0
+        loop.run_until_complete(results.aclose())
+    finally:
+        loop.close()
+
+def testpicture():
+    '''Ensure pictures are embedded through a relationship'''
+    docx = Docx()
+    docx.picture(IMAGE1_FILE, 'A description')
+    blip = docx._docbody[-1].xpath('.//a:blip', namespaces=docx.nsprefixes)[0]
+    relid = blip.get(docx.qn['r:embed'])
+    assert relid.startswith('rId')
+    docpr = docx._docbody[-1].xpath('.//wp:docPr', namespaces=docx.nsprefixes)
+    assert docpr[0].get('descr') == 'A description'
+    assert 'image1.png' in docx._media
+
+def testpicturededupe():
+    '''Ensure the same image data is embedded once'''
+    docx = Docx()
+    rels = len(docx._relationships)
+    media = len(docx._media)
+    with open(IMAGE1_FILE, 'rb') as f:
+        data = f.read()
+    docx.picture(IMAGE1_FILE, 'From a path')
+    docx.picture(io.BytesIO(data), 'From a file object')
+    docx.picture(bytearray(data), 'From the data')
+    assert len(docx._relationships) == rels + 1
+    assert len(docx._media) == media + 1
+    path = './/a:blip/@r:embed'
+    blips = [p.xpath(path, namespaces=docx.nsprefixes)[0]
+             for p in docx._docbody[-3:]]
+    assert len(set(blips)) == 1
+    path = './/wp:docPr/@id'
+    ids = [p.xpath(path, namespaces=docx.nsprefixes)[0]
+           for p in docx._docbody[-3:]]
+    assert len(set(ids)) == 3
+    extent = docx._docbody[-1].xpath('.//wp:extent',
+                                     namespaces=docx.nsprefixes)[0]
+    width, height = struct.unpack('>II', data[16:24])
+    assert extent.get('cx') == str(width * 12700)
+    assert extent.get('cy') == str(height * 12700)
+
+def testrelationships():
+    '''Ensure relationship ids are unique and shared by equal targets'''
+    docx = Docx()
+    rels = docx._relationships
+    hyperlink = ('http://schemas.openxmlformats.org/officeDocument/2006/'
+                 'relationships/hyperlink')
+    assert rels.add(hyperlink, 'http://a', 'External', 'rId40') == 'rId40'
+    assert rels.add(hyperlink, 'http://b', 'External') == 'rId41'
+    assert rels.add(hyperlink, 'http://a', 'External') == 'rId40'
+    assert rels.get('rId41') == (hyperlink, 'http://b', 'External')
+    docx.picture(IMAGE1_FILE, 'After the links')
+    tree = docx._genRelationshipsTree()
+    ids = [rel.get('Id') for rel in tree]
+    assert len(ids) == len(set(ids)) == len(rels)
+    assert ids[-1] == 'rId42'
+    assert tree[-2].get('TargetMode') == 'External'
+
+def testimageoptimizer():
+    '''Ensure pictures can be scaled down to their display size'''
+    docx = Docx()
+    optimizer = ImageOptimizer(scale=1)
+    with open(IMAGE1_FILE, 'rb') as f:
+        data = f.read()
+    docx.picturemany([{'picfilepath': IMAGE1_FILE, 'picdescription': 'Small',
+                       'pixelwidth': 50},
+                      {'picfilepath': io.BytesIO(data),
+                       'picdescription': 'Same', 'pixelwidth': 50}],
+                     optimize=optimizer)
+    assert (optimizer.misses, optimizer.hits) == (1, 0)
+    media = docx._media['image1-50x16.png']
+    assert len(media) < len(data)
+    assert struct.unpack('>II', media[16:24]) == (50, 16)
+    blips = [p.xpath('.//a:blip/@r:embed', namespaces=docx.nsprefixes)[0]
+             for p in docx._docbody[-2:]]
+    assert blips[0] == blips[1]
+    # A batch larger than the cache is still optimized once per image
+    optimizer = ImageOptimizer(scale=1, maxsize=1)
+    docx.picturemany([{'picfilepath': IMAGE1_FILE, 'picdescription': 'Size',
+                       'pixelwidth': width} for width in (40, 30, 20)],
+                     optimize=optimizer)
+    assert (optimizer.misses, optimizer.hits) == (3, 0)
+    assert 'image1-20x6.png' in docx._media
+    # Colour profiles are dropped along with the pixels
+    from docx import Image
+    source = io.BytesIO()
+    Image.new('RGB', (100, 100)).save(source, 'PNG', icc_profile=b'profile')
+    assert b'iCCP' in source.getvalue()
+    optimized, ext = ImageOptimizer(scale=1).optimize(source.getvalue(), 50, 50)
+    assert ext == '.png'
+    assert struct.unpack('>II', optimized[16:24]) == (50, 50)
+    assert b'iCCP' not in optimized
+
+def testprototypecache():
+    '''Ensure repeated paragraph styles reuse cached properties'''
+    docx = Docx()
+    docx.prototypecache.clear()
+    for i in range(3):
+        docx.paragraph([('bold', 'b'), ('plain', '')], style='ListNumber')
+    assert docx.prototypecache.misses == 3
+    assert docx.prototypecache.hits == 6
+    first, last = docx._docbody[-3], docx._docbody[-1]
+    assert first[0] is not last[0]
+    assert lxml.etree.tostring(first) == lxml.etree.tostring(last)
+    assert first.xpath('w:r[1]/w:rPr/w:b', namespaces=docx.nsprefixes)
+
+def testiterdocumenttext():
+    '''Ensure streamed text extraction matches getdocumenttext'''
+    docx = simpledoc()
+    docx.savedocx(TEST_FILE)
+    paratextlist = list(iterdocumenttext(TEST_FILE))
+    assert paratextlist == Docx(TEST_FILE, cache=False).getdocumenttext()
+    assert 'Paragraph 3' in paratextlist
+    # A text box holds paragraphs inside a paragraph
+    qn = Docx.qn
+    outer = docx.paragraph('Before ')
+    box = lxml.etree.SubElement(lxml.etree.SubElement(outer, qn['w:r']),
+                                qn['w:txbxContent'])
+    box.append(docx.paragraph('inbox'))
+    after = lxml.etree.SubElement(lxml.etree.SubElement(outer, qn['w:r']),
+                                  qn['w:t'])
+    after.text = ' after'
+    docx.savedocx(TEST_FILE)
+    paratextlist = list(iterdocumenttext(TEST_FILE))
+    assert paratextlist[-2:] == ['Before inbox after', 'inbox']
+    assert paratextlist == Docx(TEST_FILE, cache=False).getdocumenttext()
+
+def testlazymedia():
+    '''Ensure template media is only read when needed and copied on save'''
+    import zipfile
+    simpledoc().savedocx(TEST_FILE)
+    docx = Docx(TEST_FILE, cache=False)
+    assert 'image1.png' in docx._media
+    assert docx._media.istemplate('image1.png')
+    output = 'LazyMedia.docx'
+    try:
+        docx.savedocx(output)
+        original = zipfile.ZipFile(TEST_FILE).read('word/media/image1.png')
+        assert zipfile.ZipFile(output).read('word/media/image1.png') == \
+            original
+        assert docx._media['image1.png'] == original
+        # Saving over the template itself
+        Docx(output, cache=False).savedocx(output)
+        assert zipfile.ZipFile(output).read('word/media/image1.png') == \
+            original
+        # And streaming over it
+        docx = Docx(output, cache=False)
+        docx.startstream(output)
+        docx.paragraph('streamed')
+        docx.endstream()
+        assert zipfile.ZipFile(output).read('word/media/image1.png') == \
+            original
+        # Documents sharing the cached template still save once it is
+        # replaced
+        first, second = Docx(output), Docx(output)
+        first.paragraph('first')
+        first.savedocx(output)
+        second.paragraph('second')
+        second.savedocx(TEST_FILE)
+        saved = Docx(TEST_FILE, cache=False)
+        assert saved._media['image1.png'] == original
+        assert saved.getdocumenttext()[-1] == 'second'
+        assert Docx(output).getdocumenttext()[-1] == 'first'
+    finally:
+        os.remove(output)
+
+def testbulktable():
+    '''Ensure bulk tables take rows or columns, in memory or streamed'''
+    docx = Docx()
+    table = docx.bulktable([['A1', 2], ['B1', None]], heading=['x', 'y'])
+    rows = table.xpath('w:tr', namespaces=docx.nsprefixes)
+    assert len(rows) == 3
+    assert [''.join(row.itertext()) for row in rows] == ['xy', 'A12', 'B1']
+    # Like table(), True takes the heading from the first row
+    same = docx.bulktable([['x', 'y'], ['A1', 2], ['B1', None]], heading=True)
+    assert lxml.etree.tostring(same) == lxml.etree.tostring(table)
+    plain = docx.bulktable([['A1', 2]], heading=False)
+    assert len(plain.xpath('w:tr', namespaces=docx.nsprefixes)) == 1
+    columns = docx.bulktable([['A1', 'B1'], [' A2', 'B2']], columnar=True)
+    assert columns.xpath('string(w:tr[1])', namespaces=docx.nsprefixes) == \
+        'A1 A2'
+
+    docx = Docx()
+    docx.startstream(TEST_FILE)
+    assert docx.bulktable((['r%s' % i, i] for i in range(1000))) is None
+    docx.paragraph('After')
+    docx.endstream()
+    paratextlist = list(iterdocumenttext(TEST_FILE))
+    assert paratextlist[:2] == ['r0', '0']
+    assert paratextlist[-3:] == ['r999', '999', 'After']
+
+def testgettables():
+    '''Ensure tables are read back as rows or columns'''
+    docx = Docx()
+    docx.table([['Name', 'Qty'], ['Bolt', '3'], ['Nut', '5']])
+    docx.paragraph('Between')
+    docx.bulktable([['x', 1], ['y', 2]])
+    rows = [['Name', 'Qty'], ['Bolt', '3'], ['Nut', '5']]
+    assert docx.gettables() == [rows, [['x', '1'], ['y', '2']]]
+    assert docx.gettables(columnar=True)[1] == [['x', 'y'], ['1', '2']]
+    assert docx.gettables(columnar=True, heading=True)[0] == \
+        {'Name': ['Bolt', 'Nut'], 'Qty': ['3', '5']}
+    docx.savedocx(TEST_FILE)
+    assert list(itertables(TEST_FILE)) == docx.gettables()
+
 if __name__ == '__main__':
     import nose
     nose.main()